@@ -6,6 +6,7 @@ import queue
 
 from mutex import Mutex
 
+from song import backfill_song_lengths
 from song_queue import SongQueue
 from commands import Command
 from music_player import start_music_player
@@ -34,6 +35,9 @@ def main():
 	logging.info("Starting webserver daemon thread")
 	ws_thread.start()
 
+	logging.info("Starting song length backfill daemon thread")
+	threading.Thread(target=backfill_song_lengths, daemon=True).start()
+
 	logging.info("Starting music player")
 	start_music_player(event_queue, song_queue)
 
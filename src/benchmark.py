@@ -0,0 +1,256 @@
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from synthetic_library import SILENT_MP3_FRAME, WORDS
+
+if __name__ != "__main__":
+    print("This should be run as a stand-alone script, not imported as a module")
+    sys.exit()
+
+# Times the hot paths against synthetic libraries of various sizes. Each library size runs in its own
+# process (the database module binds to settings.DATABASE_FILE at import time), and the results come
+# out as JSON so they can be compared against a stored baseline:
+#
+#   python benchmark.py --output results.json
+#   python benchmark.py --sizes 1000,10000 --baseline results.json
+
+SRC_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_SIZES = [1_000, 10_000, 100_000, 1_000_000]
+REGRESSION_THRESHOLD = 1.2
+
+USER_COUNT = 10
+PLAYLIST_COUNT = 5
+PLAYLIST_SIZE = 500
+INSERT_CHUNK_SIZE = 10_000
+
+Timings = Dict[str, float]
+
+def time_operation(fn: Callable[[], Any], iterations: int) -> Timings:
+    for _ in range(min(3, iterations)):
+        fn()
+
+    samples: "list[float]" = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - start) * 1_000_000)
+
+    samples.sort()
+    return {
+        "iterations": iterations,
+        "min_us": samples[0],
+        "median_us": statistics.median(samples),
+        "mean_us": statistics.fmean(samples),
+        "p95_us": samples[min(len(samples) - 1, int(len(samples) * 0.95))],
+        "max_us": samples[-1],
+    }
+
+def random_song_name(rng: random.Random) -> str:
+    return " ".join(rng.choice(WORDS) for _ in range(rng.randint(2, 6))).title()
+
+def build_library(db: Any, size: int, rng: random.Random) -> Tuple["list[int]", "list[int]", "list[str]"]:
+    user_ids = [db.add_user(f"user{i}", "hash:salt:1") for i in range(USER_COUNT)]
+
+    song_ids: "list[int]" = []
+    for chunk_start in range(0, size, INSERT_CHUNK_SIZE):
+        chunk = range(chunk_start, min(size, chunk_start + INSERT_CHUNK_SIZE))
+        song_ids += db.add_songs([(random_song_name(rng), f"vid{i:011d}", 0) for i in chunk])
+
+    ratings_per_user = max(1, size // 20)
+    for user_id in user_ids:
+        rated = rng.sample(song_ids, ratings_per_user)
+        db.add_ratings([(user_id, song_id, rng.randint(1, 5)) for song_id in rated])
+
+    playlist_ids: "list[int]" = []
+    for i in range(PLAYLIST_COUNT):
+        playlist_id = db.add_playlist(f"Playlist {i}")
+        db.add_songs_to_playlist(rng.sample(song_ids, min(size, PLAYLIST_SIZE)), playlist_id)
+        playlist_ids.append(playlist_id)
+
+    session_ids = [db.create_session(user_id, "2999-01-01T00:00:00+00:00") for user_id in user_ids]
+
+    return (user_ids, playlist_ids, session_ids)
+
+def run_size(size: int, workdir: str, iterations: int) -> "dict[str, Timings]":
+    import settings
+    settings.DATA_DIRECTORY = workdir
+    settings.MUSIC_DIR = os.path.join(workdir, "music")
+    settings.DATABASE_FILE = os.path.join(workdir, "database.db")
+    # No audio hardware needed (or wanted) to time the queue
+    settings.PREFERRED_AUDIO_OUTPUT_ORDER = ["simulated"]
+    settings.SIMULATED_SPEAKER_SPEED = 1.0
+    os.makedirs(settings.MUSIC_DIR, exist_ok=True)
+
+    from bottle import template
+    from database import database
+    from song import DownloadState, Song
+    from song_queue import SongQueue
+    from web_sessions import Sessions
+
+    rng = random.Random(size)
+
+    build_start = time.perf_counter()
+    (user_ids, playlist_ids, session_ids) = build_library(database, size, rng)
+    logging.info(f"Built a {size} song library in {time.perf_counter() - build_start:.1f}s")
+
+    sessions = Sessions()
+    for session_id in session_ids[:USER_COUNT // 2]:
+        sessions.update_last_active(session_id)
+
+    listening = sessions.recently_active_users()
+
+    song_queue = SongQueue()
+    song_queue.default_all_playlist.whos_listening = lambda: listening
+    for _ in range(5):
+        song = database.get_random_song()
+        assert song is not None
+        song_queue.queue_song(Song.from_db_song(song, DownloadState.Downloaded))
+
+    # Only the songs that end up on screen need a file behind them
+    def ensure_song_file(s: Song) -> None:
+        if s.id != -1 and not os.path.exists(s.path):
+            with open(s.path, "wb") as f:
+                f.write(SILENT_MP3_FRAME * 100)
+
+    song_queue.next_song()
+    for s in [song_queue.currently_playing.song, *song_queue.up_next]:
+        ensure_song_file(s)
+
+    db_song = database.get_song(1)
+    assert db_song is not None
+    search_page = [Song.from_db_song(s, DownloadState.Downloaded) for s in database.search_songs("love", 0, 10)]
+    for s in search_page:
+        ensure_song_file(s)
+
+    def next_song() -> None:
+        song_queue.next_song()
+        ensure_song_file(song_queue.currently_playing.song)
+
+    results: "dict[str, Timings]" = {}
+    operations: "list[tuple[str, Callable[[], Any]]]" = [
+        ("search_songs", lambda: database.search_songs(rng.choice(WORDS), 0, 10)),
+        ("search_songs_count", lambda: database.get_search_song_count(rng.choice(WORDS))),
+        ("get_random_song", database.get_random_song),
+        ("get_random_song_rated_not_low_by_users", lambda: database.get_random_song_rated_not_low_by_users(listening)),
+        ("get_random_playlist_song", lambda: database.get_random_playlist_song(playlist_ids[0])),
+        ("get_next_playlist_song", lambda: database.get_next_playlist_song(playlist_ids[0], rng.randrange(PLAYLIST_SIZE))),
+        ("song_queue_next_song", next_song),
+        ("song_from_db_song", lambda: Song.from_db_song(db_song, DownloadState.Downloaded)),
+        ("render_index", lambda: template("index",
+            state=song_queue.snapshot,
+            username="user0",
+            rating=3
+        )),
+        ("render_songs", lambda: template("songs",
+            songs=search_page,
+            search="love",
+            youtube_searched=False,
+            current_page=1,
+            total_pages=10
+        )),
+        ("sessions_recently_active_users", sessions.recently_active_users),
+    ]
+
+    for (name, fn) in operations:
+        results[name] = time_operation(fn, iterations)
+        logging.info(f"{size} songs - {name}: median {results[name]['median_us']:.1f}us")
+
+    database.close()
+    return results
+
+def run_all(sizes: "list[int]", iterations: int) -> "dict[str, Any]":
+    results: "dict[str, Any]" = {}
+
+    for size in sizes:
+        with tempfile.TemporaryDirectory(prefix=f"mp_bench_{size}_") as workdir:
+            logging.info(f"Running benchmarks against {size} songs in {workdir}")
+            out = subprocess.check_output(
+                [sys.executable, __file__, "--run-size", str(size), "--workdir", workdir, "--iterations", str(iterations)],
+                cwd=SRC_DIR
+            )
+            results[str(size)] = json.loads(out)
+
+    return {
+        "meta": {
+            "timestamp": time.time(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "machine": platform.machine(),
+            "iterations": iterations,
+        },
+        "results": results,
+    }
+
+def compare(current: "dict[str, Any]", baseline: "dict[str, Any]") -> bool:
+    # On stderr, so stdout stays nothing but the JSON results for anyone piping them somewhere
+    regressed = False
+
+    print(f"{'size':>9} {'operation':<40} {'baseline':>12} {'current':>12} {'ratio':>7}", file=sys.stderr)
+    for (size, operations) in current["results"].items():
+        baseline_operations = baseline["results"].get(size, {})
+        for (name, timings) in operations.items():
+            base = baseline_operations.get(name)
+            if base is None:
+                continue
+
+            ratio = timings["median_us"] / base["median_us"] if base["median_us"] else float("inf")
+            flag = ""
+            if ratio > REGRESSION_THRESHOLD:
+                flag = " <-- slower"
+                regressed = True
+
+            print(f"{size:>9} {name:<40} {base['median_us']:>10.1f}us {timings['median_us']:>10.1f}us {ratio:>6.2f}x{flag}", file=sys.stderr)
+
+    return regressed
+
+def main() -> Optional[int]:
+    parser = argparse.ArgumentParser(description="Benchmark the music player's hot paths against synthetic libraries")
+    parser.add_argument("--sizes", default=",".join(str(s) for s in DEFAULT_SIZES), help="Comma separated library sizes")
+    parser.add_argument("--iterations", type=int, default=200)
+    parser.add_argument("--output", help="Write the JSON results here (otherwise they go to stdout)")
+    parser.add_argument("--baseline", help="JSON results from a previous run to compare against")
+    parser.add_argument("--fail-on-regression", action="store_true", help=f"Exit non-zero if anything is more than {REGRESSION_THRESHOLD}x slower than the baseline")
+    parser.add_argument("--run-size", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--workdir", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_size is not None:
+        # Child process - keep stdout for the JSON
+        level = logging.INFO if os.environ.get("BENCHMARK_VERBOSE") else logging.WARNING
+        logging.basicConfig(stream=sys.stderr, level=level, format="%(asctime)s:%(levelname)s:%(name)s:%(message)s")
+        json.dump(run_size(args.run_size, args.workdir, args.iterations), sys.stdout)
+        return None
+
+    logging.basicConfig(stream=sys.stderr, level=logging.INFO, format="%(asctime)s:%(levelname)s:%(name)s:%(message)s")
+
+    sizes: List[int] = [int(s) for s in args.sizes.split(",") if s.strip()]
+    results = run_all(sizes, args.iterations)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+        logging.info(f"Results written to {args.output}")
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+        if compare(results, baseline) and args.fail_on_regression:
+            return 1
+
+    return None
+
+sys.exit(main())
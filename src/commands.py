@@ -13,7 +13,10 @@ class DownloadCommand:
 	def __init__(self, url: str):
 		self.url = url
 
-class SkipCommand: pass
+class SkipCommand:
+	def __init__(self, count: int = 1) -> None:
+		# More than one when several skips arrived together and got merged
+		self.count = count
 
 class VolumeCommand:
 	def __init__(self, volume: float) -> None:
@@ -32,6 +35,13 @@ class DeleteCommand:
 	def __init__(self, song_id: int) -> None:
 		self.song_id = song_id
 
+# Not sent by the webserver - these wake the music player up when something happens in the background
+class SongFinishedCommand: pass
+
+class SongDownloadedCommand:
+	def __init__(self, song_id: int) -> None:
+		self.song_id = song_id
+
 Command = Union[
 	PlayCommand,
 	PauseCommand,
@@ -41,5 +51,7 @@ Command = Union[
 	VolumeCommand,
 	ChangePlaylistCommand,
 	CreatePlaylistFromUrlCommand,
-	DeleteCommand
+	DeleteCommand,
+	SongFinishedCommand,
+	SongDownloadedCommand
 ]
\ No newline at end of file
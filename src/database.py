@@ -1,11 +1,24 @@
+from array import array
+import atexit
+from collections import OrderedDict
+from concurrent.futures import Future
 import logging
+import random
 import sqlite3
-from typing import Optional, List, Tuple, Union, NamedTuple
+import threading
+import time
+import weakref
+from typing import Any, Callable, Hashable, Iterator, Optional, List, Tuple, TypeVar, Union, NamedTuple
 import os
+import queue
 import uuid
 from datetime import datetime, timezone
 
 import settings
+from query_stats import InstrumentedCursor, recorder as query_recorder
+from schema_migrations import LATEST_VERSION, MIGRATIONS
+
+T = TypeVar("T")
 
 class User(NamedTuple):
     id: int
@@ -22,6 +35,7 @@ class Song(NamedTuple):
     name: str
     youtube_id: str
     start_time_ms: Optional[int]
+    length_ms: Optional[int]
 
     def path(self) -> str:
         return os.path.join(settings.MUSIC_DIR, self.youtube_id + ".mp3")
@@ -68,24 +82,329 @@ class Session(NamedTuple):
     def all_from_db(cursor: sqlite3.Cursor) -> List["Session"]:
         return [Session(*obj) for obj in cursor.fetchall()]
 
+class _RandomSongIds:
+    # Keeps the song IDs eligible for a random pick per (who's listening, playlist) in memory, so every
+    # pick after the first is a random.choice rather than an ORDER BY RANDOM() over the whole table.
+    # Most writes that could change eligibility just throw everything away - ratings only affect the
+    # pools picked for listeners that include whoever rated.
+    _max_pools = 8
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._pools: "OrderedDict[Hashable, array[int]]" = OrderedDict()
+        self._generation = 0
+
+    def pick(self, key: Hashable, load_ids: Callable[[], "list[int]"]) -> Optional[int]:
+        with self._lock:
+            ids = self._pools.get(key)
+            generation = self._generation
+            if ids is not None:
+                self._pools.move_to_end(key)
+
+        if ids is None:
+            ids = array("q", load_ids())
+
+            with self._lock:
+                # Don't cache anything loaded from before an invalidation
+                if generation == self._generation:
+                    self._pools[key] = ids
+                    if len(self._pools) > self._max_pools:
+                        self._pools.popitem(last=False)
+
+        return random.choice(ids) if ids else None
+
+    def invalidate(self) -> None:
+        with self._lock:
+            self._generation += 1
+            self._pools.clear()
+
+    def invalidate_for_user(self, user_id: int) -> None:
+        with self._lock:
+            # Loads already in flight for other pools just don't get cached this once
+            self._generation += 1
+            for key in [k for k in self._pools if self._includes_user(k, user_id)]:
+                del self._pools[key]
+
+    @staticmethod
+    def _includes_user(key: Hashable, user_id: int) -> bool:
+        return isinstance(key, tuple) and len(key) == 2 and key[0] == "rated_not_low" and user_id in key[1]
+
+class _SongCache:
+    # Bounded LRU of Songs rows keyed by song_id, with a youtube_id -> song_id index on the side.
+    # Lookups that miss record the generation they started at, and anything invalidated while they
+    # were off querying isn't cached, so a read racing a write can't put a stale row back.
+    def __init__(self, capacity: int) -> None:
+        self._capacity = capacity
+        self._lock = threading.Lock()
+        self._songs: "OrderedDict[int, Song]" = OrderedDict()
+        self._ids_by_youtube_id: "dict[str, int]" = {}
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def generation(self) -> int:
+        return self._generation
+
+    def get(self, song_id: int) -> Optional[Song]:
+        with self._lock:
+            song = self._songs.get(song_id)
+            if song is None:
+                self.misses += 1
+                return None
+
+            self._songs.move_to_end(song_id)
+            self.hits += 1
+            return song
+
+    def get_by_youtube_id(self, youtube_id: str) -> Optional[Song]:
+        with self._lock:
+            song_id = self._ids_by_youtube_id.get(youtube_id)
+            song = self._songs.get(song_id) if song_id is not None else None
+            if song is None:
+                self.misses += 1
+                return None
+
+            self._songs.move_to_end(song.id)
+            self.hits += 1
+            return song
+
+    def put(self, song: Song, generation: int) -> None:
+        with self._lock:
+            if generation != self._generation:
+                return
+
+            self._songs[song.id] = song
+            self._songs.move_to_end(song.id)
+            self._ids_by_youtube_id[song.youtube_id] = song.id
+
+            if len(self._songs) > self._capacity:
+                (_, evicted) = self._songs.popitem(last=False)
+                self._ids_by_youtube_id.pop(evicted.youtube_id, None)
+
+    def invalidate(self, song_id: Optional[int] = None, youtube_id: Optional[str] = None) -> None:
+        with self._lock:
+            self._generation += 1
+
+            if youtube_id is not None and song_id is None:
+                song_id = self._ids_by_youtube_id.get(youtube_id)
+
+            song = self._songs.pop(song_id, None) if song_id is not None else None
+            if song is not None:
+                self._ids_by_youtube_id.pop(song.youtube_id, None)
+
+    def stats(self) -> "dict[str, int]":
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "size": len(self._songs), "capacity": self._capacity}
+
+class _DatabaseWriter:
+    # Owns the only connection that writes. Callers queue operations and get a Future back, and the writer
+    # thread drains whatever has piled up into a single transaction. Each operation runs in its own
+    # savepoint so one failing only rolls back itself, not everything else that was batched with it.
+    _max_batch_size = 100
+
+    def __init__(self, connect: Callable[[], sqlite3.Connection]) -> None:
+        self._connect = connect
+        self._queue: "queue.Queue[Optional[_WriteOp]]" = queue.Queue()
+        # Set if the writer thread ever dies, so writes fail straight away rather than waiting forever
+        self._failure: Optional[BaseException] = None
+        self._in_flight: "list[_WriteOp]" = []
+        self._thread = threading.Thread(target=self._run, name="DatabaseWriter", daemon=True)
+        self._thread.start()
+
+    def submit(self, op: "Callable[[sqlite3.Cursor], T]", after_commit: Optional[Callable[[], None]]) -> "Future[T]":
+        future: "Future[T]" = Future()
+        self._queue.put(_WriteOp(op, after_commit, future))
+        if self._failure is not None:
+            # The writer may have drained the queue before this went in
+            self._fail_pending(self._failure)
+        return future
+
+    def stop(self) -> None:
+        self._queue.put(None)
+        self._thread.join()
+
+    def _run(self) -> None:
+        try:
+            self._write_until_stopped()
+        except BaseException as ex:
+            logging.exception("Database writer thread died")
+            self._failure = ex
+            self._fail_pending(ex)
+            raise
+
+    def _fail_pending(self, ex: BaseException) -> None:
+        for op in self._in_flight:
+            if not op.future.done():
+                op.future.set_exception(ex)
+
+        while True:
+            try:
+                op = self._queue.get_nowait()
+            except queue.Empty:
+                return
+            if op is not None and not op.future.done():
+                op.future.set_exception(ex)
+
+    def _write_until_stopped(self) -> None:
+        conn = self._connect()
+
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < self._max_batch_size and batch[-1] is not None:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            ops = [op for op in batch if op is not None]
+            if ops:
+                self._in_flight = ops
+                self._write_batch(conn, ops)
+                self._in_flight = []
+
+            if batch[-1] is None:
+                return
+
+    def _write_batch(self, conn: sqlite3.Connection, ops: "list[_WriteOp]") -> None:
+        results: "list[Tuple[_WriteOp, Any, Optional[BaseException]]]" = []
+        cursor = conn.cursor()
+
+        try:
+            cursor.execute("BEGIN IMMEDIATE")
+
+            for op in ops:
+                if not op.future.set_running_or_notify_cancel():
+                    continue
+
+                cursor.execute("SAVEPOINT write_op")
+                try:
+                    results.append((op, op.op(cursor), None))
+                    cursor.execute("RELEASE write_op")
+                except Exception as ex:
+                    cursor.execute("ROLLBACK TO write_op")
+                    cursor.execute("RELEASE write_op")
+                    results.append((op, None, ex))
+
+            # The commit (and its fsync) isn't a statement, so time it separately
+            commit_start = time.perf_counter()
+            conn.commit()
+            query_recorder.record("COMMIT", time.perf_counter() - commit_start, len(results))
+        except Exception as ex:
+            logging.exception(f"Failed to commit a batch of {len(ops)} database write(s)")
+            conn.rollback()
+            for op in ops:
+                if not op.future.done():
+                    op.future.set_exception(ex)
+            return
+
+        for (op, result, ex) in results:
+            if ex is not None:
+                op.future.set_exception(ex)
+                continue
+
+            if op.after_commit is not None:
+                try:
+                    op.after_commit()
+                except Exception:
+                    # The write itself is committed, so the caller still gets its result
+                    logging.exception("after_commit callback for a database write failed")
+            op.future.set_result(result)
+
+class _WriteOp(NamedTuple):
+    op: "Callable[[sqlite3.Cursor], Any]"
+    after_commit: Optional[Callable[[], None]]
+    future: "Future[Any]"
+
+class _PooledConnection(sqlite3.Connection):
+    # Subclassed so connections can be tracked in a WeakSet (and closed on shutdown), and so every
+    # cursor handed out records timings for the statements run through it
+    def cursor(self, factory: "type[sqlite3.Cursor]" = InstrumentedCursor) -> sqlite3.Cursor: # type: ignore[override]
+        return super().cursor(factory)
+
 class Database:
-    _expected_metadata_version = 1
+    _expected_metadata_version = LATEST_VERSION
+
+    _statement_cache_size = 256
+    _song_cache_size = 2048
+    _pragmas = [
+        "PRAGMA journal_mode = WAL",
+        "PRAGMA synchronous = NORMAL",
+        "PRAGMA cache_size = -8000", # Negative means KiB, so ~8MB
+        "PRAGMA mmap_size = 67108864", # 64MB
+        "PRAGMA busy_timeout = 5000",
+        "PRAGMA temp_store = MEMORY",
+    ]
 
     def __init__(self):
         self.db_name = settings.DATABASE_FILE
+        self._local = threading.local()
+        self._connections: "weakref.WeakSet[_PooledConnection]" = weakref.WeakSet()
+        self._connections_lock = threading.Lock()
+        self._random_song_ids = _RandomSongIds()
+        self._song_cache = _SongCache(self._song_cache_size)
+        self._writer: Optional[_DatabaseWriter] = None
+        self._writer_lock = threading.Lock()
+
         metadata_version = self._get_metadata_version()
 
         if metadata_version == 0:
             self._initialize_schema()
             metadata_version = self._get_metadata_version()
 
+        if metadata_version < self._expected_metadata_version:
+            self._run_migrations(metadata_version)
+            metadata_version = self._get_metadata_version()
+
         if metadata_version != self._expected_metadata_version:
             raise RuntimeError(f"The DB metadata version {metadata_version} was not the same as the expected one {self._expected_metadata_version}. This may mean that you have upgraded without running migration scripts, or you've downgraded beyond a DB schema change")
 
+        self._song_search_index_available = self._table_exists("SongsSearch")
+
+    def _connect(self) -> sqlite3.Connection:
+        # One long-lived connection per thread. WAL mode means readers on the web thread don't block
+        # on (or get blocked by) the player/download threads writing.
+        conn: Optional[_PooledConnection] = getattr(self._local, "conn", None)
+        if conn is None:
+            # check_same_thread is off only so that close() can shut everything down from whichever
+            # thread is exiting - each connection is otherwise only ever used by the thread that opened it
+            conn = sqlite3.connect(
+                self.db_name,
+                factory=_PooledConnection,
+                cached_statements=self._statement_cache_size,
+                check_same_thread=False
+            )
+            for pragma in self._pragmas:
+                conn.execute(pragma)
+
+            self._local.conn = conn
+            with self._connections_lock:
+                self._connections.add(conn)
+
+        return conn
+
+    def close(self) -> None:
+        with self._writer_lock:
+            writer = self._writer
+            self._writer = None
+
+        # Let anything already queued get written before the connections go away
+        if writer is not None:
+            writer.stop()
+
+        with self._connections_lock:
+            connections = list(self._connections)
+            self._connections.clear()
+
+        for conn in connections:
+            conn.close()
+
+        # Anything still running after this point will transparently open a fresh connection
+        self._local = threading.local()
+
     def _initialize_schema(self):
         logging.info(f"Initializing schema at {self.db_name}")
         
-        with sqlite3.connect(self.db_name) as conn:
+        with self._connect() as conn:
             cursor = conn.cursor()
             
             cursor.execute('''
@@ -152,45 +471,110 @@ class Database:
             ''')
             conn.commit()
 
-    def add_user(self, username: str, password_hash: str) -> int:
-        with sqlite3.connect(self.db_name) as conn:
+    def _run_migrations(self, from_version: int) -> None:
+        conn = self._connect()
+
+        for version in range(from_version + 1, self._expected_metadata_version + 1):
+            logging.info(f"Migrating schema at {self.db_name} from version {version - 1} to {version}")
+
             cursor = conn.cursor()
+            try:
+                cursor.execute("BEGIN")
+                MIGRATIONS[version](cursor)
+                cursor.execute("UPDATE Metadata SET version = ?", (version,))
+                conn.commit()
+            except:
+                conn.rollback()
+                logging.exception(f"Schema migration to version {version} failed, rolled back to version {version - 1}")
+                raise
+
+    def add_user(self, username: str, password_hash: str) -> int:
+        def op(cursor: sqlite3.Cursor) -> int:
             cursor.execute("INSERT INTO Users (username, password_hash) VALUES (?, ?)", (username, password_hash))
-            conn.commit()
             return self._last_row_id(cursor)
 
-    def add_song(self, song_name: str, youtube_id: str, start_time_ms: int = 0) -> int:
-        with sqlite3.connect(self.db_name) as conn:
-            cursor = conn.cursor()
+        return self._write(op).result()
+
+    def add_song(self, song_name: str, youtube_id: str, start_time_ms: int = 0, length_ms: Optional[int] = None) -> int:
+        def op(cursor: sqlite3.Cursor) -> int:
             cursor.execute("""
-                INSERT INTO Songs (song_name, youtube_id, start_time_ms)
-                VALUES (?, ?, ?)
-            """, (song_name, youtube_id, start_time_ms))
-            conn.commit()
+                INSERT INTO Songs (song_name, youtube_id, start_time_ms, length_ms)
+                VALUES (?, ?, ?, ?)
+            """, (song_name, youtube_id, start_time_ms, length_ms))
             return self._last_row_id(cursor)
 
-    def add_rating(self, user_id: int, song_id: int, rating: int) -> int:
-        with sqlite3.connect(self.db_name) as conn:
-            cursor = conn.cursor()
+        def after_commit() -> None:
+            self._random_song_ids.invalidate()
+            self._song_cache.invalidate(youtube_id=youtube_id)
+
+        return self._write(op, after_commit).result()
+
+    def add_songs(self, songs: "list[Tuple[str, str, int]]") -> "list[int]":
+        # (song_name, youtube_id, start_time_ms) for each song, all inserted in a single transaction.
+        # Executed row by row rather than with executemany so the new IDs can be handed back.
+        def op(cursor: sqlite3.Cursor) -> "list[int]":
+            ids: "list[int]" = []
+            for (song_name, youtube_id, start_time_ms) in songs:
+                cursor.execute("""
+                    INSERT INTO Songs (song_name, youtube_id, start_time_ms)
+                    VALUES (?, ?, ?)
+                """, (song_name, youtube_id, start_time_ms))
+                ids.append(self._last_row_id(cursor))
+            return ids
+
+        def after_commit() -> None:
+            self._random_song_ids.invalidate()
+            for (_, youtube_id, _) in songs:
+                self._song_cache.invalidate(youtube_id=youtube_id)
+
+        return self._write(op, after_commit).result()
+
+    def set_song_lengths(self, lengths: "list[Tuple[int, int]]") -> None:
+        # (song_id, length_ms) for each song
+        def op(cursor: sqlite3.Cursor) -> None:
+            cursor.executemany("UPDATE Songs SET length_ms = ? WHERE song_id = ?", [(length_ms, song_id) for (song_id, length_ms) in lengths])
+
+        def after_commit() -> None:
+            for (song_id, _) in lengths:
+                self._song_cache.invalidate(song_id)
+
+        self._write(op, after_commit).result()
+
+    def add_rating(self, user_id: int, song_id: int, rating: int) -> None:
+        # Nobody needs to wait on a rating, so this returns as soon as it's queued
+        def op(cursor: sqlite3.Cursor) -> None:
             cursor.execute("""
                 INSERT INTO Ratings (user_id, song_id, rating)
                 VALUES (?, ?, ?)
                 ON CONFLICT(user_id, song_id) DO UPDATE SET rating = excluded.rating
             """, (user_id, song_id, rating))
-            conn.commit()
-            return self._last_row_id(cursor)
+
+        self._write_in_background(op, lambda: self._random_song_ids.invalidate_for_user(user_id))
+
+    def add_ratings(self, ratings: "list[Tuple[int, int, int]]") -> None:
+        # (user_id, song_id, rating) for each rating, all upserted in a single transaction
+        def op(cursor: sqlite3.Cursor) -> None:
+            cursor.executemany("""
+                INSERT INTO Ratings (user_id, song_id, rating)
+                VALUES (?, ?, ?)
+                ON CONFLICT(user_id, song_id) DO UPDATE SET rating = excluded.rating
+            """, ratings)
+
+        def after_commit() -> None:
+            for user_id in {user_id for (user_id, _, _) in ratings}:
+                self._random_song_ids.invalidate_for_user(user_id)
+
+        self._write(op, after_commit).result()
 
     def add_playlist(self, playlist_name: str) -> int:
-        with sqlite3.connect(self.db_name) as conn:
-            cursor = conn.cursor()
+        def op(cursor: sqlite3.Cursor) -> int:
             cursor.execute("INSERT INTO Playlists (name) VALUES (?)", (playlist_name,))
-            conn.commit()
             return self._last_row_id(cursor)
+
+        return self._write(op).result()
         
     def add_song_to_playlist(self, song_id: int, playlist_id: int) -> int:
-        with sqlite3.connect(self.db_name) as conn:
-            cursor = conn.cursor()
-        
+        def op(cursor: sqlite3.Cursor) -> int:
             cursor.execute("""
                 SELECT COALESCE(MAX(idx), -1) + 1
                 FROM PlaylistSongs
@@ -204,11 +588,24 @@ class Database:
                 VALUES (?, ?, ?)
             """, (song_id, playlist_id, next_idx))
 
-            conn.commit()
             return self._last_row_id(cursor)
 
+        return self._write(op, self._random_song_ids.invalidate).result()
+
+    def add_songs_to_playlist(self, song_ids: "list[int]", playlist_id: int) -> None:
+        def op(cursor: sqlite3.Cursor) -> None:
+            # Each row works out its own index as it goes in, which is cheap thanks to the (playlist_id, idx) index
+            cursor.executemany("""
+                INSERT INTO PlaylistSongs (song_id, playlist_id, idx)
+                SELECT ?, ?, COALESCE(MAX(idx), -1) + 1
+                FROM PlaylistSongs
+                WHERE playlist_id = ?
+            """, [(song_id, playlist_id, playlist_id) for song_id in song_ids])
+
+        self._write(op, self._random_song_ids.invalidate).result()
+
     def get_user(self, name_or_id: Union[str, int]) -> Optional[User]:
-        with sqlite3.connect(self.db_name) as conn:
+        with self._connect() as conn:
             cursor = conn.cursor()
             if isinstance(name_or_id, int):
                 cursor.execute("SELECT * FROM Users WHERE user_id = ?", (name_or_id,))
@@ -217,69 +614,158 @@ class Database:
             return User.from_db(cursor)
 
     def get_song(self, id_or_name: Union[str, int]) -> Optional[Song]:
-        with sqlite3.connect(self.db_name) as conn:
-            cursor = conn.cursor()
-            if isinstance(id_or_name, int):
-                cursor.execute("SELECT * FROM Songs WHERE song_id = ?", (id_or_name,))
-            else:
+        if not isinstance(id_or_name, int):
+            with self._connect() as conn:
+                cursor = conn.cursor()
                 cursor.execute("SELECT * FROM Songs WHERE song_name = ?", (id_or_name,))
-            return Song.from_db(cursor)
+                return Song.from_db(cursor)
+
+        song = self._song_cache.get(id_or_name)
+        if song is not None:
+            return song
+
+        generation = self._song_cache.generation()
+        with self._connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT * FROM Songs WHERE song_id = ?", (id_or_name,))
+            song = Song.from_db(cursor)
+
+        if song is not None:
+            self._song_cache.put(song, generation)
+        return song
         
     def get_total_song_count(self) -> int:
-        with sqlite3.connect(self.db_name) as conn:
+        with self._connect() as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT COUNT(*) FROM Songs")
             result = cursor.fetchone()
             return int(result[0]) if result else 0
     
-    def get_songs(self) -> "list[Song]":
-        with sqlite3.connect(self.db_name) as conn:
+    def get_songs(self, offset: int = 0, limit: Optional[int] = None) -> "list[Song]":
+        with self._connect() as conn:
             cursor = conn.cursor()
-            cursor.execute("SELECT * FROM Songs")
+            cursor.execute("SELECT * FROM Songs ORDER BY song_id LIMIT ? OFFSET ?", (self._sql_limit(limit), offset))
             return Song.all_from_db(cursor)
         
+    def iter_songs(self, chunk_size: int = 500, without_length: bool = False) -> Iterator[Song]:
+        # Streams every song in chunks, each chunk its own short query picking up after the last song_id seen.
+        # Memory stays bounded, and no read snapshot is held open while the caller works through them.
+        last_id = -1
+        length_filter = "AND length_ms IS NULL" if without_length else ""
+
+        while True:
+            with self._connect() as conn:
+                cursor = conn.cursor()
+                cursor.execute(f"SELECT * FROM Songs WHERE song_id > ? {length_filter} ORDER BY song_id LIMIT ?", (last_id, chunk_size))
+                chunk = Song.all_from_db(cursor)
+
+            yield from chunk
+
+            if len(chunk) < chunk_size:
+                return
+            last_id = chunk[-1].id
+
     def get_song_by_youtube_id(self, yt_id: str) -> Optional[Song]:
-        with sqlite3.connect(self.db_name) as conn:
+        song = self._song_cache.get_by_youtube_id(yt_id)
+        if song is not None:
+            return song
+
+        generation = self._song_cache.generation()
+        with self._connect() as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT * FROM Songs WHERE youtube_id = ?", (yt_id,))
-            return Song.from_db(cursor)
-        
-    def search_songs(self, query: str) -> "list[Song]":
-        words = query.lower().split()
+            song = Song.from_db(cursor)
 
-        if not words:
+        if song is not None:
+            self._song_cache.put(song, generation)
+        return song
+
+    def song_cache_stats(self) -> "dict[str, int]":
+        return self._song_cache.stats()
+
+    def query_stats(self) -> "list[dict[str, Any]]":
+        return query_recorder.summary()
+        
+    def search_songs(self, query: str, offset: int = 0, limit: Optional[int] = None) -> "list[Song]":
+        search = self._song_search(query)
+        if search is None:
             return []
 
-        conditions = " AND ".join([f"LOWER(song_name) LIKE ?" for _ in words])
-        parameters = [f"%{word}%" for word in words]
+        (from_where, parameters, order_by) = search
 
-        with sqlite3.connect(self.db_name) as conn:
+        with self._connect() as conn:
             cursor = conn.cursor()
             cursor.execute(f"""
-                SELECT * FROM Songs
-                WHERE {conditions}
-            """, parameters)
+                SELECT s.*
+                {from_where}
+                ORDER BY {order_by}
+                LIMIT ? OFFSET ?
+            """, [*parameters, self._sql_limit(limit), offset])
 
             return Song.all_from_db(cursor)
 
+    def get_search_song_count(self, query: str) -> int:
+        search = self._song_search(query)
+        if search is None:
+            return 0
+
+        (from_where, parameters, _) = search
+
+        with self._connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute(f"SELECT COUNT(*) {from_where}", parameters)
+            result = cursor.fetchone()
+            return int(result[0]) if result else 0
+
+    def get_search_matching_song_ids(self, query: str, youtube_ids: "list[str]") -> "set[int]":
+        # Which of these videos the search would have found locally - checks just them rather than
+        # loading every match
+        search = self._song_search(query)
+        if search is None or not youtube_ids:
+            return set()
+
+        (from_where, parameters, _) = search
+        placeholders = ",".join("?" for _ in youtube_ids)
+
+        with self._connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute(f"SELECT s.song_id {from_where} AND s.youtube_id IN ({placeholders})", [*parameters, *youtube_ids])
+            return {int(row[0]) for row in cursor.fetchall()}
+
+    def _song_search(self, query: str) -> Optional[Tuple[str, "list[str]", str]]:
+        words = query.lower().split()
+
+        if not words:
+            return None
+
+        if self._song_search_index_available:
+            # Quote every word so punctuation in the search isn't treated as FTS syntax, then make it a prefix match
+            match = " ".join('"' + word.replace('"', '""') + '"*' for word in words)
+            return (
+                "FROM SongsSearch JOIN Songs s ON s.song_id = SongsSearch.rowid WHERE SongsSearch MATCH ?",
+                [match],
+                "bm25(SongsSearch)"
+            )
+
+        conditions = " AND ".join([f"LOWER(s.song_name) LIKE ?" for _ in words])
+        parameters = [f"%{word}%" for word in words]
+        return (f"FROM Songs s WHERE {conditions}", parameters, "s.song_id")
+
     def get_rating_for_song(self, user_id: int, song_id: int) -> Optional[int]:
-        with sqlite3.connect(self.db_name) as conn:
+        with self._connect() as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT rating FROM Ratings WHERE user_id = ? AND song_id = ?", (user_id, song_id))
             result = cursor.fetchone()
             return int(result[0]) if result else None
 
     def get_ratings_for_song(self, song_id: int) -> List[int]:
-        with sqlite3.connect(self.db_name) as conn:
+        with self._connect() as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT rating FROM Ratings WHERE song_id = ?", (song_id,))
             return [int(row) for row in cursor.fetchall()]
         
     def get_random_song(self) -> Optional[Song]:
-        with sqlite3.connect(self.db_name) as conn:
-            cursor = conn.cursor()
-            cursor.execute("SELECT * FROM Songs ORDER BY RANDOM() LIMIT 1")
-            return Song.from_db(cursor)
+        return self._pick_random_song(("all",), "SELECT song_id FROM Songs", [])
         
     def get_random_song_rated_not_low_by_users(self, user_ids: List[int]) -> Optional[Song]:
         if not user_ids:
@@ -287,23 +773,37 @@ class Database:
 
         placeholders = ','.join('?' for _ in user_ids)
         query = f'''
-            SELECT s.*
+            SELECT DISTINCT s.song_id
             FROM Songs s
             LEFT JOIN Ratings r ON s.song_id = r.song_id AND r.user_id IN ({placeholders})
             WHERE (r.rating IS NULL OR r.rating > 2)
-            ORDER BY RANDOM()
-            LIMIT 1
         '''
 
-        logging.info(f"Non-low rated song query: {query} params: {user_ids}")
+        return self._pick_random_song(("rated_not_low", frozenset(user_ids)), query, user_ids)
 
-        with sqlite3.connect(self.db_name) as conn:
-            cursor = conn.cursor()
-            cursor.execute(query, user_ids)
-            return Song.from_db(cursor)
+    def _pick_random_song(self, key: Hashable, ids_query: str, parameters: "list[int]") -> Optional[Song]:
+        def load_ids() -> "list[int]":
+            logging.info(f"Loading song IDs for random selection: {ids_query} params: {parameters}")
+            with self._connect() as conn:
+                cursor = conn.cursor()
+                cursor.execute(ids_query, parameters)
+                return [int(row[0]) for row in cursor.fetchall()]
+
+        song_id = self._random_song_ids.pick(key, load_ids)
+        if song_id is None:
+            return None
+
+        song = self.get_song(song_id)
+        if song is None:
+            # Removed by something that didn't go through this class (e.g. another process), start over
+            self._random_song_ids.invalidate()
+            song_id = self._random_song_ids.pick(key, load_ids)
+            song = self.get_song(song_id) if song_id is not None else None
+
+        return song
         
     def get_playlist(self, playlist_id: Union[int, str]) -> Optional[Playlist]:
-        with sqlite3.connect(self.db_name) as conn:
+        with self._connect() as conn:
             cursor = conn.cursor()
             if isinstance(playlist_id, int):
                 cursor.execute("SELECT * FROM Playlists WHERE playlist_id = ?", (playlist_id,))
@@ -312,13 +812,13 @@ class Database:
             return Playlist.from_db(cursor)
         
     def get_all_playlists(self) -> List[Playlist]:
-        with sqlite3.connect(self.db_name) as conn:
+        with self._connect() as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT * FROM Playlists")
             return Playlist.all_from_db(cursor)
         
     def get_next_playlist_song(self, playlist_id: int, current_idx: int) -> Tuple[Optional[Song], bool]:
-        with sqlite3.connect(self.db_name) as conn:
+        with self._connect() as conn:
             cursor = conn.cursor()
             
             cursor.execute("""
@@ -348,41 +848,62 @@ class Database:
 
             return (result, back_to_start)
         
+    def iter_playlist_songs(self, playlist_id: int, chunk_size: int = 500) -> Iterator[Song]:
+        # In playlist order, chunked the same way as iter_songs
+        last_idx = -1
+
+        while True:
+            with self._connect() as conn:
+                cursor = conn.cursor()
+                cursor.execute("""
+                    SELECT ps.idx, s.*
+                    FROM PlaylistSongs ps
+                    JOIN Songs s ON ps.song_id = s.song_id
+                    WHERE ps.playlist_id = ? AND ps.idx > ?
+                    ORDER BY ps.idx
+                    LIMIT ?
+                """, (playlist_id, last_idx, chunk_size))
+                rows = cursor.fetchall()
+
+            yield from (Song(*row[1:]) for row in rows)
+
+            if len(rows) < chunk_size:
+                return
+            last_idx = rows[-1][0]
+
     def get_random_playlist_song(self, playlist_id: int) -> Optional[Song]:
-        with sqlite3.connect(self.db_name) as conn:
-            cursor = conn.cursor()
-            cursor.execute("""
-                SELECT s.*
-                FROM PlaylistSongs ps
-                JOIN Songs s ON ps.song_id = s.song_id
-                WHERE ps.playlist_id = ?
-                ORDER BY RANDOM()
-                LIMIT 1
-            """, (playlist_id,))
-            return Song.from_db(cursor)
+        return self._pick_random_song(
+            ("playlist", playlist_id),
+            "SELECT song_id FROM PlaylistSongs WHERE playlist_id = ?",
+            [playlist_id]
+        )
 
     def remove_song(self, song_id: int):
-        with sqlite3.connect(self.db_name) as conn:
-            cursor = conn.cursor()
+        def op(cursor: sqlite3.Cursor) -> None:
             cursor.execute("DELETE FROM Songs WHERE song_id = ?", (song_id,))
             cursor.execute("DELETE FROM Ratings WHERE song_id = ?", (song_id,))
             cursor.execute("DELETE FROM PlaylistSongs WHERE song_id = ?", (song_id,))
-            conn.commit()
+
+        def after_commit() -> None:
+            self._random_song_ids.invalidate()
+            self._song_cache.invalidate(song_id)
+
+        self._write(op, after_commit).result()
         
     def create_session(self, user_id: int, expires_at: str) -> str:
         session_id = str(uuid.uuid4())
         
-        with sqlite3.connect(self.db_name) as conn:
-            cursor = conn.cursor()
+        def op(cursor: sqlite3.Cursor) -> None:
             cursor.execute("INSERT INTO UserSessions (session_id, expires_at, user_id) VALUES (?, ?, ?)", (session_id, expires_at, user_id))
-            conn.commit()
-        
+
+        # Wait for this one - the login redirect will look the session up straight away
+        self._write(op).result()
         return session_id
 
     def get_session(self, session_id: str) -> Optional[Session]:
         now = datetime.now(timezone.utc).replace(microsecond=0).isoformat()
 
-        with sqlite3.connect(self.db_name) as conn:
+        with self._connect() as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT * FROM UserSessions WHERE session_id = ? AND expires_at > ?", (session_id, now))
             return Session.from_db(cursor)
@@ -390,22 +911,46 @@ class Database:
     def get_active_sessions(self) -> List[Session]:
         now = datetime.now(timezone.utc).replace(microsecond=0).isoformat()
 
-        with sqlite3.connect(self.db_name) as conn:
+        with self._connect() as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT * FROM UserSessions WHERE expires_at > ?", (now,))
             return Session.all_from_db(cursor)
         
     def remove_session(self, session_id: str):
-        with sqlite3.connect(self.db_name) as conn:
-            cursor = conn.cursor()
+        def op(cursor: sqlite3.Cursor) -> None:
             cursor.execute("DELETE FROM UserSessions WHERE session_id = ?", (session_id,))
-            conn.commit()
+
+        self._write_in_background(op)
         
     def remove_users_session(self, user_id: int):
-        with sqlite3.connect(self.db_name) as conn:
-            cursor = conn.cursor()
+        def op(cursor: sqlite3.Cursor) -> None:
             cursor.execute("DELETE FROM UserSessions WHERE user_id = ?", (user_id,))
-            conn.commit()
+
+        self._write_in_background(op)
+
+    def remove_expired_sessions(self):
+        now = datetime.now(timezone.utc).replace(microsecond=0).isoformat()
+
+        def op(cursor: sqlite3.Cursor) -> None:
+            cursor.execute("DELETE FROM UserSessions WHERE expires_at <= ?", (now,))
+
+        self._write_in_background(op)
+
+    def _write(self, op: "Callable[[sqlite3.Cursor], T]", after_commit: Optional[Callable[[], None]] = None) -> "Future[T]":
+        with self._writer_lock:
+            if self._writer is None:
+                self._writer = _DatabaseWriter(self._connect)
+            writer = self._writer
+
+        return writer.submit(op, after_commit)
+
+    def _write_in_background(self, op: "Callable[[sqlite3.Cursor], None]", after_commit: Optional[Callable[[], None]] = None) -> None:
+        def log_failure(future: "Future[None]") -> None:
+            ex = future.exception()
+            if ex is not None:
+                logging.error("Background database write failed", exc_info=ex)
+
+        self._write(op, after_commit).add_done_callback(log_failure)
 
     def _last_row_id(self, cursor) -> int:
         if cursor.lastrowid is not None:
@@ -413,14 +958,25 @@ class Database:
         else:
             raise ValueError("No last row ID found.")
         
+    def _sql_limit(self, limit: Optional[int]) -> int:
+        # SQLite treats a negative LIMIT as no limit at all
+        return -1 if limit is None else limit
+
+    def _table_exists(self, name: str) -> bool:
+        with self._connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT 1 FROM sqlite_master WHERE name = ?", (name,))
+            return cursor.fetchone() is not None
+
     def _get_metadata_version(self) -> int:
         if not os.path.exists(self.db_name):
             return 0
         
-        with sqlite3.connect(self.db_name) as conn:
+        with self._connect() as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT version FROM Metadata")
             result = cursor.fetchone()
             return int(result[0])
 
-database = Database()
\ No newline at end of file
+database = Database()
+atexit.register(database.close)
\ No newline at end of file
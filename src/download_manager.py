@@ -0,0 +1,208 @@
+from collections import deque
+from enum import IntEnum
+import heapq
+import itertools
+import logging
+import threading
+import time
+from typing import Any, Callable, Dict, Optional
+
+from song import DownloadState, Song
+from song_filename_generator import get_name
+import youtube_dl as yt_dl
+import settings
+
+class DownloadPriority(IntEnum):
+	# Lower goes first
+	USER = 0
+	NEXT_UP = 1
+	BULK = 2
+
+class DownloadJob:
+	def __init__(self, video_id: str, url: str, song: Song, priority: DownloadPriority, resolve_name: bool, finish: Callable[[Song], None]):
+		self.video_id = video_id
+		self.url = url
+		self.song = song
+		self.priority = priority
+		self.resolve_name = resolve_name
+		# Run before the song is marked downloaded, so by then it has its id and path
+		self.finish = finish
+		self.on_complete: "list[Callable[[Song], None]]" = []
+		self.cancel_event = threading.Event()
+		self.started_at: Optional[float] = None
+
+class DownloadManager:
+	# A fixed pool of worker threads taking jobs off a priority queue - songs a user asked for jump
+	# ahead of songs about to be played, which jump ahead of whatever a playlist import queued up.
+	# A video that's already queued or downloading isn't downloaded twice, the second caller just
+	# gets the same placeholder song back.
+	_attempts = 2
+	_throughput_window_secs = 10 * 60
+
+	def __init__(self, workers: int):
+		self.workers = workers
+		self._cond = threading.Condition()
+		# (priority, seq, job) - re-prioritising pushes a new entry, and the stale one gets skipped
+		self._heap: "list[tuple[int, int, DownloadJob]]" = []
+		self._seq = itertools.count()
+		self._jobs: Dict[str, DownloadJob] = {}
+		self._active: Dict[str, DownloadJob] = {}
+
+		self.completed = 0
+		self.failed = 0
+		self.cancelled = 0
+		self.download_secs = 0.0
+		self._recent_completions: "deque[float]" = deque()
+
+		for i in range(workers):
+			threading.Thread(target=self._run_worker, name=f"Downloader-{i}", daemon=True).start()
+
+	def submit(self, url: str, video_id: str, song_name: Optional[str], priority: DownloadPriority, finish: Callable[[Song], None], on_complete: Optional[Callable[[Song], None]] = None) -> Song:
+		with self._cond:
+			job = self._jobs.get(video_id)
+			if job is None:
+				song = Song(-1, song_name or f"YouTube video {video_id}", "", DownloadState.Downloading)
+				song.downloading_video_id = video_id
+				job = DownloadJob(video_id, url, song, priority, song_name is None, finish)
+				self._jobs[video_id] = job
+				self._push_locked(job)
+				logging.info(f"Queued download of {video_id} at {priority.name} priority")
+			else:
+				logging.info(f"Download of {video_id} already in progress")
+				if priority < job.priority and job.started_at is None:
+					job.priority = priority
+					self._push_locked(job)
+
+			if on_complete: job.on_complete.append(on_complete)
+			return job.song
+
+	def cancel(self, video_id: str) -> bool:
+		with self._cond:
+			job = self._jobs.pop(video_id, None)
+			if job is None:
+				return False
+
+			# A queued job gets skipped when it reaches the top of the heap, a running one stops at the
+			# next line youtube-dl prints
+			job.cancel_event.set()
+			if job.started_at is None:
+				self.cancelled += 1
+
+		if job.started_at is None:
+			job.song.downloading = DownloadState.Error
+		logging.info(f"Cancelled download of {video_id}")
+		return True
+
+	def stats(self) -> Dict[str, Any]:
+		with self._cond:
+			now = time.monotonic()
+			self._trim_recent_locked(now)
+			return {
+				"workers": self.workers,
+				# Not len(_jobs) - len(_active) - a cancelled job leaves _jobs straight away, but stays active
+				# until its worker notices
+				"queued": sum(1 for job in self._jobs.values() if job.started_at is None and not job.cancel_event.is_set()),
+				"active": [
+					{"video_id": job.video_id, "priority": job.priority.name, "percent": job.song.download_percentage, "secs": now - job.started_at}
+					for job in self._active.values() if job.started_at is not None
+				],
+				"completed": self.completed,
+				"failed": self.failed,
+				"cancelled": self.cancelled,
+				"completed_per_min": len(self._recent_completions) * 60 / self._throughput_window_secs,
+				"mean_download_secs": self.download_secs / self.completed if self.completed else 0.0,
+			}
+
+	def _push_locked(self, job: DownloadJob) -> None:
+		heapq.heappush(self._heap, (job.priority, next(self._seq), job))
+		self._cond.notify()
+
+	def _next_job(self) -> DownloadJob:
+		with self._cond:
+			while True:
+				while not self._heap:
+					self._cond.wait()
+
+				(priority, _, job) = heapq.heappop(self._heap)
+				if job.cancel_event.is_set() or job.started_at is not None or priority != job.priority:
+					continue
+
+				job.started_at = time.monotonic()
+				self._active[job.video_id] = job
+				return job
+
+	def _run_worker(self) -> None:
+		while True:
+			job = self._next_job()
+			try:
+				succeeded = self._download(job)
+			except:
+				logging.exception(f"Unexpected error downloading {job.video_id}")
+				succeeded = False
+
+			with self._cond:
+				self._active.pop(job.video_id, None)
+				if self._jobs.get(job.video_id) is job:
+					del self._jobs[job.video_id]
+
+				assert job.started_at is not None
+				now = time.monotonic()
+				if succeeded:
+					self.completed += 1
+					self.download_secs += now - job.started_at
+					self._recent_completions.append(now)
+					self._trim_recent_locked(now)
+				elif job.cancel_event.is_set():
+					self.cancelled += 1
+				else:
+					self.failed += 1
+
+				callbacks = list(job.on_complete)
+
+			if not succeeded:
+				job.song.downloading = DownloadState.Error
+				continue
+
+			job.song.downloading_video_id = None
+			for callback in callbacks:
+				try:
+					callback(job.song)
+				except:
+					logging.exception(f"Download completion callback for {job.video_id} failed")
+
+	def _download(self, job: DownloadJob) -> bool:
+		s = job.song
+		if job.resolve_name:
+			try:
+				s.name = get_name(job.url)
+			except:
+				logging.exception(f"Could not get the name for {job.url}, keeping '{s.name}'")
+
+		for attempt in range(1, self._attempts + 1):
+			# Cancelled while the last attempt was failing, or while the name was being looked up
+			if job.cancel_event.is_set():
+				return False
+
+			try:
+				logging.info(f"Starting download of {job.video_id} (attempt {attempt})")
+				yt_dl.download_audio(job.url, s.set_download_percentage, job.cancel_event)
+				break
+			except yt_dl.DownloadCancelled:
+				return False
+			except:
+				logging.exception(f"Failed to download {job.video_id}")
+				# Only given up on after the last attempt - an Error song gets auto-removed from the queue
+				if attempt >= self._attempts:
+					return False
+
+		# The song has to be in the database before it's marked downloaded, or the player could pick
+		# it up with no id or path
+		job.finish(s)
+		s.downloading = DownloadState.Downloaded
+		return True
+
+	def _trim_recent_locked(self, now: float) -> None:
+		while self._recent_completions and self._recent_completions[0] < now - self._throughput_window_secs:
+			self._recent_completions.popleft()
+
+download_manager = DownloadManager(settings.MAX_PARALLEL_DOWNLOADS)
@@ -0,0 +1,31 @@
+import logging
+import os
+import sys
+
+logging.basicConfig(
+    stream=sys.stdout,
+    level=logging.INFO,
+    format="%(asctime)s:%(levelname)s:%(name)s:%(message)s"
+)
+
+if __name__ != "__main__":
+    print("This should be run as a stand-alone script, not imported as a module")
+    sys.exit()
+
+# Builds the thumbnail variants for everything already in MUSIC_DIR. New downloads get theirs as they
+# finish, so this only needs running once (or after changing THUMBNAIL_SIZES). Safe to re-run - up to
+# date variants are skipped.
+
+from settings import MUSIC_DIR, THUMBNAIL_SIZES
+from thumbnails import queue_thumbnail_variants
+
+mp3_paths = [entry.path for entry in os.scandir(MUSIC_DIR) if entry.is_file() and entry.name.endswith(".mp3")]
+logging.info(f"Generating {THUMBNAIL_SIZES} thumbnail variants for {len(mp3_paths)} song(s) in {MUSIC_DIR}")
+
+generated = 0
+for (i, future) in enumerate([queue_thumbnail_variants(path) for path in mp3_paths], 1):
+    generated += future.result()
+    if i % 100 == 0:
+        logging.info(f"{i}/{len(mp3_paths)} songs processed")
+
+logging.info(f"Done, generated {generated} thumbnail variant(s)")
@@ -35,6 +35,11 @@ def migrate(db: "Database", USERS_DIR: str, PLAYLISTS_DIR: str, MUSIC_DIR: str):
 
     if os.path.exists(MUSIC_DIR):
         logging.info("Importing songs...")
+        pending_songs: "list[tuple[str, str, int]]" = []
+        pending_user_ratings = {}
+        # Only deleted once everything read out of them is committed, or a failed batch would lose it
+        imported_song_dirs: "list[str]" = []
+
         for ext_song_id in os.listdir(MUSIC_DIR):
             song_dir = os.path.join(MUSIC_DIR, ext_song_id)
             if not os.path.isdir(song_dir):
@@ -63,26 +68,38 @@ def migrate(db: "Database", USERS_DIR: str, PLAYLISTS_DIR: str, MUSIC_DIR: str):
                         user_ratings = json.load(f)
 
             if song_name:
-                song_db_id = db.add_song(song_name, ext_song_id, start_time_ms)
-                song_ext_id_to_db_id[ext_song_id] = song_db_id
+                pending_songs.append((song_name, ext_song_id, start_time_ms))
+                pending_user_ratings[ext_song_id] = user_ratings
+            else:
+                logging.warning(f"Skipping {ext_song_id} - couldn't find song name")
 
-                logging.info(f"Imported song {song_name} ({ext_song_id}) with id {song_db_id}")
+            imported_song_dirs.append(song_dir)
 
-                # Ratings
-                if user_ratings is not None:
-                    count = 0
-                    for username, rating in user_ratings.items():
-                        count += 1
-                        user_id = username_to_id.get(username)
-                        if user_id is not None:
-                            db.add_rating(user_id, song_db_id, rating)
+        song_db_ids = db.add_songs(pending_songs)
+        pending_ratings: "list[tuple[int, int, int]]" = []
 
-                    logging.info(f"Adding {count} found ratings to songs")
-                else:
-                    logging.info("No ratings found for this song")
+        for ((song_name, ext_song_id, _), song_db_id) in zip(pending_songs, song_db_ids):
+            song_ext_id_to_db_id[ext_song_id] = song_db_id
+
+            logging.info(f"Imported song {song_name} ({ext_song_id}) with id {song_db_id}")
+
+            # Ratings
+            user_ratings = pending_user_ratings[ext_song_id]
+            if user_ratings is not None:
+                count = 0
+                for username, rating in user_ratings.items():
+                    count += 1
+                    user_id = username_to_id.get(username)
+                    if user_id is not None:
+                        pending_ratings.append((user_id, song_db_id, rating))
+
+                logging.info(f"Adding {count} found ratings to songs")
             else:
-                logging.warning(f"Skipping {ext_song_id} - couldn't find song name")
+                logging.info("No ratings found for this song")
 
+        db.add_ratings(pending_ratings)
+
+        for song_dir in imported_song_dirs:
             shutil.rmtree(song_dir)
 
         logging.info("Finished importing songs")
@@ -100,15 +117,17 @@ def migrate(db: "Database", USERS_DIR: str, PLAYLISTS_DIR: str, MUSIC_DIR: str):
             # Create playlist
             playlist_id = db.add_playlist(playlist_name)
 
-            count = 0
+            playlist_song_ids = []
             for ext_song_id in song_ids:
                 song_id = song_ext_id_to_db_id.get(ext_song_id)
                 if song_id:
-                    count += 1
-                    db.add_song_to_playlist(song_id, playlist_id)
+                    playlist_song_ids.append(song_id)
                 else:
                     logging.warning(f"Could not find {ext_song_id} to add to playlist")
 
+            db.add_songs_to_playlist(playlist_song_ids, playlist_id)
+            count = len(playlist_song_ids)
+
             logging.info(f"Imported playlist {playlist_name} with id {playlist_id} and it's {count if count == len(song_ids) else f'{count}/{len(song_ids)}'} songs")
     else:
         logging.info("No playlist dir found, skipping playlist import")
@@ -1,45 +1,139 @@
+import os
 import pathlib
 import shutil
 import threading
 import logging
 import queue
-from typing import Callable, Optional, TypeVar, Union
+import time
+from typing import Any, Callable, Optional, Union
 from typing_extensions import Never
 
 from mutex import Mutex
 from playlist import FilePlaylist, Playlist
 
 from database import database
-from song import DownloadState, Song
-from commands import Command, CreatePlaylistFromUrlCommand, DownloadCommand, PlayCommand, PauseCommand, QueueCommand, SkipCommand, VolumeCommand, ChangePlaylistCommand, DeleteCommand
-from song_filename_generator import get_name, get_video_id, get_youtube_playlist_id_from_url
+from download_manager import DownloadPriority, download_manager
+from song import DownloadState, Song, probe_length_ms
+from commands import Command, CreatePlaylistFromUrlCommand, DownloadCommand, PlayCommand, PauseCommand, QueueCommand, SkipCommand, VolumeCommand, ChangePlaylistCommand, DeleteCommand, SongDownloadedCommand, SongFinishedCommand
+from song_filename_generator import get_video_id, get_youtube_playlist_id_from_url
 from song_queue import SongQueue
+from thumbnails import queue_thumbnail_variants
 from speaker import speaker
-import youtube_dl as yt_dl
 import youtube_api as yt_api
 import settings
 
+class CommandBatchStats:
+	def __init__(self) -> None:
+		self.batches = 0
+		self.commands = 0
+		self.coalesced = 0
+		self.max_depth = 0
+		self.total_secs = 0.0
+		self.max_secs = 0.0
+
+	def record(self, depth: int, applied: int, secs: float) -> None:
+		self.batches += 1
+		self.commands += depth
+		self.coalesced += depth - applied
+		self.max_depth = max(self.max_depth, depth)
+		self.total_secs += secs
+		self.max_secs = max(self.max_secs, secs)
+
+	def summary(self) -> "dict[str, Any]":
+		return {
+			"batches": self.batches,
+			"commands": self.commands,
+			"coalesced": self.coalesced,
+			"mean_depth": self.commands / self.batches if self.batches else 0.0,
+			"max_depth": self.max_depth,
+			"mean_ms": (self.total_secs / self.batches) * 1000 if self.batches else 0.0,
+			"max_ms": self.max_secs * 1000,
+		}
+
+command_batch_stats = CommandBatchStats()
+
 def start_music_player(event_queue: "queue.Queue[Command]", song_queue: Mutex[SongQueue]):
-	while True:
-		cmd = try_get(event_queue)
+	# Nothing polls the speaker - the end of a song arrives as a command like anything else, so this
+	# thread sleeps in get() until there's actually something to do
+	speaker().set_on_finished(lambda: event_queue.put_nowait(SongFinishedCommand()))
+
+	with song_queue.acquire() as sq:
+		advance_past_finished_songs(sq.value)
 
-		if cmd is not None:
-			process_cmd(song_queue, cmd)
+	while True:
+		# Everything that's piled up gets handled in one go, under one acquisition of the lock
+		batch = drain_commands(event_queue)
+		start = time.perf_counter()
+		commands = coalesce_commands(batch)
 
 		with song_queue.acquire() as sq:
-			if sq.value.current_song_finished():
-				sq.value.next_song()
+			for cmd in commands:
+				try:
+					process_cmd(event_queue, sq.value, cmd)
+				except:
+					logging.exception(f"Error processing cmd: '{cmd}'")
+
+			advance_past_finished_songs(sq.value)
+
+		command_batch_stats.record(len(batch), len(commands), time.perf_counter() - start)
+
+# A song that can't be played at all "finishes" immediately, so a run of them could spin forever -
+# past this many, whatever's left waits for the next command to come in
+MAX_SONGS_ADVANCED_PER_BATCH = 10
+
+def advance_past_finished_songs(sq: SongQueue) -> None:
+	for _ in range(MAX_SONGS_ADVANCED_PER_BATCH):
+		# Nothing else would wake this thread back up if an error got out of here, so a song that fails
+		# to load is logged and the next one tried
+		try:
+			if not sq.current_song_finished():
+				return
+			sq.next_song()
+		except:
+			logging.exception("Error moving on to the next song")
+
+	# Usually a string of broken files, but with the simulated speaker at speed 0 every song finishes instantly
+	logging.info(f"Still finished after moving on {MAX_SONGS_ADVANCED_PER_BATCH} songs, giving up until the next command")
 
-def process_cmd(song_queue: Mutex[SongQueue], cmd: Command) -> None:
+def drain_commands(event_queue: "queue.Queue[Command]") -> "list[Command]":
+	batch = [event_queue.get()]
+	try:
+		while True:
+			batch.append(event_queue.get_nowait())
+	except queue.Empty:
+		return batch
+
+def coalesce_commands(batch: "list[Command]") -> "list[Command]":
+	# Only the last of these in a batch makes any difference
+	last_wins = (VolumeCommand, SongFinishedCommand, SongDownloadedCommand)
+	last_of_type = {type(cmd): cmd for cmd in batch if isinstance(cmd, last_wins)}
+
+	commands: "list[Command]" = []
+	for cmd in batch:
+		if isinstance(cmd, last_wins) and last_of_type[type(cmd)] is not cmd:
+			continue
+
+		previous = commands[-1] if commands else None
+		if isinstance(cmd, SkipCommand) and isinstance(previous, SkipCommand):
+			commands[-1] = SkipCommand(previous.count + cmd.count)
+		elif isinstance(cmd, (PlayCommand, PauseCommand)) and isinstance(previous, (PlayCommand, PauseCommand)):
+			commands[-1] = cmd
+		else:
+			commands.append(cmd)
+
+	if len(commands) < len(batch):
+		logging.info(f"Coalesced {len(batch)} commands down to {len(commands)}")
+
+	return commands
+
+def process_cmd(event_queue: "queue.Queue[Command]", sq: SongQueue, cmd: Command) -> None:
 	logging.info(f"Processing cmd: '{cmd}'")
 
 	if isinstance(cmd, PlayCommand):
-		with song_queue.acquire() as sq:
-			sq.value.play()
+		sq.play()
 
 	elif isinstance(cmd, PauseCommand):
-		with song_queue.acquire() as sq:
-			sq.value.pause()
+		sq.pause()
 
 	elif isinstance(cmd, QueueCommand):
 		song = database.get_song(cmd.song_id)
@@ -50,35 +144,30 @@ def process_cmd(song_queue: Mutex[SongQueue], cmd: Command) -> None:
 		
 		song = Song.from_db_song(song, DownloadState.Downloaded)
 
-		with song_queue.acquire() as sq:
-			if cmd.is_priority:
-				sq.value.queue_song_priority(song)
-			else:
-				sq.value.queue_song(song)
+		if cmd.is_priority:
+			sq.queue_song_priority(song)
+		else:
+			sq.queue_song(song)
 
 	elif isinstance(cmd, DownloadCommand):
-		song = background_download_song_if_necessary(cmd.url)
-
-		with song_queue.acquire() as sq:
-			sq.value.queue_song(song)
+		song = background_download_song_if_necessary(cmd.url, on_complete=lambda s: event_queue.put_nowait(SongDownloadedCommand(s.id)))
+		sq.queue_song(song)
 
 	elif isinstance(cmd, SkipCommand):
-		with song_queue.acquire() as sq:
-			sq.value.next_song()
+		sq.next_song(cmd.count)
 
 	elif isinstance(cmd, VolumeCommand):
-		speaker().set_volume(cmd.volume)
+		sq.set_volume(cmd.volume)
 
 	elif isinstance(cmd, ChangePlaylistCommand):
-		with song_queue.acquire() as sq:
-			sq.value.change_playlist(cmd.id, cmd.shuffle)
+		sq.change_playlist(cmd.id, cmd.shuffle)
 
 	elif isinstance(cmd, CreatePlaylistFromUrlCommand):
 		def on_complete(playlist: Playlist) -> None:
-			with song_queue.acquire() as sq:
-				sq.value.change_playlist(playlist.id, False)
+			event_queue.put_nowait(ChangePlaylistCommand(playlist.id, False))
 
-		background_download_playlist(cmd.url, on_complete)
+		# Looking up the playlist is all network calls, so it gets its own thread
+		threading.Thread(target=background_download_playlist, args=(cmd.url, on_complete), name="PlaylistImport", daemon=True).start()
 
 	elif isinstance(cmd, DeleteCommand):
 		song = database.get_song(cmd.song_id)
@@ -91,18 +180,19 @@ def process_cmd(song_queue: Mutex[SongQueue], cmd: Command) -> None:
 		shutil.rmtree(pathlib.Path(song.thumbnail_jpg()).parent.absolute())
 		shutil.rmtree(pathlib.Path(song.thumbnail_webp()).parent.absolute())
 
+	elif isinstance(cmd, SongFinishedCommand):
+		# Moving on to the next song is handled back in the main loop, same as after any other command
+		pass
+
+	elif isinstance(cmd, SongDownloadedCommand):
+		# Might now be the next song to play, instead of whatever was preloaded
+		sq.preload_next_song()
+
 	else:
 		exhausted: Never = cmd
 		raise Exception(f"Unknown command {exhausted}")
 
-T = TypeVar("T")
-def try_get(q: "queue.Queue[T]") -> Optional[T]:
-	try:
-		return q.get(timeout=1)
-	except queue.Empty:
-		return None
-
-def background_download_song_if_necessary(url: str, song_name: Optional[str] = None, on_complete: Optional[Callable[[Song], None]] = None) -> Song:
+def background_download_song_if_necessary(url: str, song_name: Optional[str] = None, on_complete: Optional[Callable[[Song], None]] = None, priority: DownloadPriority = DownloadPriority.USER) -> Song:
 	logging.info(f"Starting download process for {url}")
 	vid_id = get_video_id(url)
 	if vid_id is None:
@@ -115,49 +205,22 @@ def background_download_song_if_necessary(url: str, song_name: Optional[str] = N
 		return Song.from_db_song(existing_song, DownloadState.Downloaded)
 	else:
 		logging.info("Song does not exist, starting download")
-		song_name = song_name or get_name(url)
 
-		def on_complete_override(s: Song):
-			id = database.add_song(song_name, vid_id, 0)
+		def add_to_database(s: Song):
+			# Still on the download thread, so this is a fine place to pay for reading the file
+			mp3_path = os.path.join(settings.MUSIC_DIR, vid_id + ".mp3")
+			length_ms = probe_length_ms(mp3_path)
+			queue_thumbnail_variants(mp3_path)
+			id = database.add_song(s.name, vid_id, 0, length_ms)
 			new_song = database.get_song(id)
 			assert new_song is not None
 
 			s.id = id
 			s.path = new_song.path()
 
-			if on_complete: on_complete(s)
-
-		s = Song(-1, song_name, "", DownloadState.Downloading)
-		background_download_song(url, s, on_complete_override)
-		return s
-
-def background_download_song(url: str, s: Song, on_complete: Optional[Callable[[Song], None]] = None) -> None:
-	t = threading.Thread(target=download_song, args=(url, s, on_complete), daemon=True)
-	t.start()
-
-__downloader_semaphore = threading.BoundedSemaphore(settings.MAX_PARALLEL_DOWNLOADS)
-
-def download_song(url: str, s: Song, on_complete: Optional[Callable[[Song], None]] = None) -> None:
-	attempts = 0
-
-	while attempts < 2:
-		attempts += 1
-
-		try:
-			logging.info("Waiting to acquire semaphore...")
-			with __downloader_semaphore:
-				logging.info("Semaphore acquired, starting download")
-				yt_dl.download_audio(url, s.set_download_percentage)
-				s.downloading = DownloadState.Downloaded
-				if on_complete: on_complete(s)
-				break
-		except:
-			logging.exception("Failed to download, setting .downloading to Error")
-			if attempts >= 2:
-				# Only set on final failure - otherwise it will get auto-removed from the queue
-				s.downloading = DownloadState.Error
-
-
+		# Goes in the queue straight away - looking the name up means a network call (or worse, a
+		# youtube-dl process) so that happens on the download thread, and the name gets filled in after
+		return download_manager.submit(url, vid_id, song_name, priority, add_to_database, on_complete)
 
 def background_download_playlist(url: str, on_complete: Callable[[Playlist], None]) -> None:
 	logging.info(f"Starting playlist download for {url}")
@@ -198,6 +261,6 @@ def background_download_playlist(url: str, on_complete: Callable[[Playlist], Non
 
 	for vid in playlist_videos:
 		vid_url = f"https://www.youtube.com/watch?v={vid.id}"
-		background_download_song_if_necessary(vid_url, vid.name, on_song_complete)
+		background_download_song_if_necessary(vid_url, vid.name, on_song_complete, DownloadPriority.BULK)
 
 # pyright: reportUnnecessaryIsInstance=false
\ No newline at end of file
@@ -1,5 +1,6 @@
+import time
 from types import TracebackType
-from typing import Optional, Type, TypeVar, Generic
+from typing import Any, Dict, Optional, Type, TypeVar, Generic
 from threading import Lock
 from typing_extensions import Self
 
@@ -19,7 +20,15 @@ class Mutex(Generic[T]):
             self.mutex._value = value
 
         def __enter__(self) -> Self:
-            self.mutex._lock.acquire()
+            lock = self.mutex._lock
+            if not lock.acquire(blocking=False):
+                start = time.perf_counter()
+                lock.acquire()
+                # Only ever touched while holding the lock, so these don't need any protecting of their own
+                self.mutex._contended += 1
+                self.mutex._wait_secs += time.perf_counter() - start
+
+            self.mutex._acquisitions += 1
             return self
 
         def __exit__(self,
@@ -33,5 +42,16 @@ class Mutex(Generic[T]):
         self._lock = Lock()
         self._value = initial_value
 
+        self._acquisitions = 0
+        self._contended = 0
+        self._wait_secs = 0.0
+
     def acquire(self) -> "MutexGuard[T]":
-        return Mutex.MutexGuard(self)
\ No newline at end of file
+        return Mutex.MutexGuard(self)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "acquisitions": self._acquisitions,
+            "contended": self._contended,
+            "wait_ms": self._wait_secs * 1000,
+        }
\ No newline at end of file
@@ -19,7 +19,8 @@ class PlayingSong:
 		self.load()
 
 	def load(self):
-		speaker().load(self.song.path)
+		# The start time gets applied as part of loading, so the skipped part is never heard
+		speaker().load(self.song.path, self.song.start_time)
 
 	def play(self):
 		if self.playing_state == PlayingState.NotStarted:
@@ -39,10 +40,6 @@ class PlayingSong:
 	def is_finished(self) -> bool:
 		return self.playing_state == PlayingState.Playing and not speaker().get_busy()
 	
-	def skip_to_overridden_start(self):
-		if self.song.start_time > 0:
-			speaker().set_pos(self.song.start_time)
-	
 	def current_elapsed_time_secs(self) -> Optional[float]:
 		pos = speaker().get_pos()
 		if pos == -1:
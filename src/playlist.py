@@ -44,8 +44,7 @@ class FilePlaylist(Playlist):
     @staticmethod
     def create_playlist(name: str, songs: "list[Song]") -> Playlist:
         id = database.add_playlist(name)
-        for song in songs:
-            database.add_song_to_playlist(song.id, id)
+        database.add_songs_to_playlist([song.id for song in songs], id)
 
         return FilePlaylist(id, name)
 
@@ -0,0 +1,190 @@
+import logging
+import re
+import sqlite3
+import threading
+import time
+from collections import deque
+from typing import Any, Iterable, List, Optional, Tuple
+
+import settings
+
+# Every statement run through an InstrumentedCursor is timed (execute plus fetching its rows) and
+# recorded against its normalised SQL. Anything slower than settings.SLOW_QUERY_THRESHOLD_MS gets
+# logged with its EXPLAIN QUERY PLAN so table scans stand out.
+
+_whitespace = re.compile(r"\s+")
+_placeholder_list = re.compile(r"\?(\s*,\s*\?)+")
+
+def normalise_sql(sql: str) -> str:
+    sql = _whitespace.sub(" ", sql).strip()
+    # Queries built with a variable number of placeholders should still count as the one query
+    return _placeholder_list.sub("?, ...", sql)
+
+class QueryStats:
+    _max_samples = 1000
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.calls = 0
+        self.total_secs = 0.0
+        self.max_secs = 0.0
+        self.rows = 0
+        self.slow_calls = 0
+        self.last_slow_plan: Optional[List[str]] = None
+        self._samples: "deque[float]" = deque(maxlen=self._max_samples)
+
+    def record(self, secs: float, rows: int) -> None:
+        self.calls += 1
+        self.total_secs += secs
+        self.max_secs = max(self.max_secs, secs)
+        self.rows += rows
+        self._samples.append(secs)
+
+    def summary(self) -> "dict[str, Any]":
+        samples = sorted(self._samples)
+
+        def percentile_ms(p: float) -> float:
+            if not samples:
+                return 0.0
+            return samples[min(len(samples) - 1, int(len(samples) * p))] * 1000
+
+        return {
+            "query": self.name,
+            "calls": self.calls,
+            "total_ms": self.total_secs * 1000,
+            "mean_ms": (self.total_secs / self.calls) * 1000 if self.calls else 0.0,
+            "p50_ms": percentile_ms(0.5),
+            "p95_ms": percentile_ms(0.95),
+            "p99_ms": percentile_ms(0.99),
+            "max_ms": self.max_secs * 1000,
+            "rows": self.rows,
+            "rows_per_call": self.rows / self.calls if self.calls else 0.0,
+            "slow_calls": self.slow_calls,
+            "last_slow_plan": self.last_slow_plan,
+        }
+
+class QueryRecorder:
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._stats: "dict[str, QueryStats]" = {}
+
+    def record(self, sql: str, secs: float, rows: int, plan: Optional[List[str]] = None) -> None:
+        name = normalise_sql(sql)
+
+        with self._lock:
+            stats = self._stats.get(name)
+            if stats is None:
+                stats = self._stats[name] = QueryStats(name)
+
+            stats.record(secs, rows)
+            if plan is not None:
+                stats.slow_calls += 1
+                stats.last_slow_plan = plan
+
+    def summary(self) -> "list[dict[str, Any]]":
+        with self._lock:
+            summaries = [stats.summary() for stats in self._stats.values()]
+
+        return sorted(summaries, key=lambda s: s["total_ms"], reverse=True)
+
+    def reset(self) -> None:
+        with self._lock:
+            self._stats.clear()
+
+recorder = QueryRecorder()
+
+class InstrumentedCursor(sqlite3.Cursor):
+    def __init__(self, connection: sqlite3.Connection) -> None:
+        super().__init__(connection)
+        # (sql, parameters, seconds so far, rows so far) for a statement whose rows haven't all been read yet
+        self._pending: Optional[Tuple[str, Any, float, int]] = None
+
+    def execute(self, sql: str, parameters: Any = ()) -> "InstrumentedCursor":
+        self._finish()
+
+        start = time.perf_counter()
+        super().execute(sql, parameters)
+        elapsed = time.perf_counter() - start
+
+        if self.description is None:
+            self._record(sql, parameters, elapsed, max(self.rowcount, 0))
+        else:
+            self._pending = (sql, parameters, elapsed, 0)
+
+        return self
+
+    def executemany(self, sql: str, seq_of_parameters: Iterable[Any]) -> "InstrumentedCursor":
+        self._finish()
+
+        start = time.perf_counter()
+        super().executemany(sql, seq_of_parameters)
+        self._record(sql, None, time.perf_counter() - start, max(self.rowcount, 0))
+
+        return self
+
+    def fetchone(self) -> Any:
+        start = time.perf_counter()
+        row = super().fetchone()
+        self._fetched(time.perf_counter() - start, 0 if row is None else 1, True)
+        return row
+
+    def fetchmany(self, size: Optional[int] = None) -> "list[Any]":
+        size = self.arraysize if size is None else size
+
+        start = time.perf_counter()
+        rows = super().fetchmany(size)
+        self._fetched(time.perf_counter() - start, len(rows), len(rows) < size)
+        return rows
+
+    def fetchall(self) -> "list[Any]":
+        start = time.perf_counter()
+        rows = super().fetchall()
+        self._fetched(time.perf_counter() - start, len(rows), True)
+        return rows
+
+    def close(self) -> None:
+        self._finish()
+        super().close()
+
+    def __del__(self) -> None:
+        # A cursor dropped before its rows were all read (a fetchone() on a multi-row result, a loop
+        # that broke early) still ran its statement
+        try:
+            self._finish()
+        except Exception:
+            pass
+
+    def _fetched(self, secs: float, rows: int, finished: bool) -> None:
+        if self._pending is None:
+            return
+
+        (sql, parameters, total_secs, total_rows) = self._pending
+        self._pending = (sql, parameters, total_secs + secs, total_rows + rows)
+        if finished:
+            self._finish()
+
+    def _finish(self) -> None:
+        if self._pending is not None:
+            (sql, parameters, secs, rows) = self._pending
+            self._pending = None
+            self._record(sql, parameters, secs, rows)
+
+    def _record(self, sql: str, parameters: Any, secs: float, rows: int) -> None:
+        plan = None
+        if secs * 1000 >= settings.SLOW_QUERY_THRESHOLD_MS:
+            plan = self._query_plan(sql, parameters)
+            logging.warning(f"Slow query ({secs * 1000:.1f}ms, {rows} row(s)): {normalise_sql(sql)} plan: {plan}")
+
+        recorder.record(sql, secs, rows, plan)
+
+    def _query_plan(self, sql: str, parameters: Any) -> List[str]:
+        if parameters is None or not sql.lstrip().upper().startswith(("SELECT", "INSERT", "UPDATE", "DELETE", "WITH")):
+            return []
+
+        try:
+            # A plain cursor, so explaining doesn't get recorded (or explained) itself
+            cursor = sqlite3.Cursor(self.connection)
+            cursor.execute(f"EXPLAIN QUERY PLAN {sql}", parameters)
+            return [str(row[3]) for row in cursor.fetchall()]
+        except sqlite3.Error as ex:
+            return [f"Could not get query plan: {ex}"]
@@ -0,0 +1,93 @@
+import logging
+import sqlite3
+from typing import Callable, Dict
+
+# Each migration takes the schema from (version - 1) to version. They're run in order inside a single
+# transaction each, with the Metadata version bumped in that same transaction, so a failure part way
+# through leaves the DB at the last fully applied version.
+Migration = Callable[[sqlite3.Cursor], None]
+
+def _v2_hot_path_indexes(cursor: sqlite3.Cursor) -> None:
+    # Songs.youtube_id is about to become unique, so fold any duplicates into the oldest copy first
+    cursor.execute("""
+        CREATE TEMP TABLE SongDuplicates AS
+        SELECT s.song_id AS duplicate_id, keep.keep_id AS keep_id
+        FROM Songs s
+        JOIN (
+            SELECT youtube_id, MIN(song_id) AS keep_id
+            FROM Songs
+            GROUP BY youtube_id
+            HAVING COUNT(*) > 1
+        ) keep ON s.youtube_id = keep.youtube_id AND s.song_id != keep.keep_id
+    """)
+
+    cursor.execute("""
+        UPDATE OR IGNORE Ratings
+        SET song_id = (SELECT keep_id FROM SongDuplicates WHERE duplicate_id = Ratings.song_id)
+        WHERE song_id IN (SELECT duplicate_id FROM SongDuplicates)
+    """)
+    # Anything left over is a user who rated both copies - the kept copy's rating wins
+    cursor.execute("DELETE FROM Ratings WHERE song_id IN (SELECT duplicate_id FROM SongDuplicates)")
+
+    cursor.execute("""
+        UPDATE PlaylistSongs
+        SET song_id = (SELECT keep_id FROM SongDuplicates WHERE duplicate_id = PlaylistSongs.song_id)
+        WHERE song_id IN (SELECT duplicate_id FROM SongDuplicates)
+    """)
+
+    cursor.execute("DELETE FROM Songs WHERE song_id IN (SELECT duplicate_id FROM SongDuplicates)")
+    cursor.execute("DROP TABLE temp.SongDuplicates")
+
+    cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_songs_youtube_id ON Songs (youtube_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_playlistsongs_playlist_id_idx ON PlaylistSongs (playlist_id, idx)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_playlistsongs_song_id ON PlaylistSongs (song_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_ratings_song_id ON Ratings (song_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_usersessions_expires_at ON UserSessions (expires_at)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_usersessions_user_id ON UserSessions (user_id)")
+
+def _v3_song_name_search(cursor: sqlite3.Cursor) -> None:
+    try:
+        cursor.execute('''
+            CREATE VIRTUAL TABLE SongsSearch USING fts5(
+                song_name,
+                content='Songs',
+                content_rowid='song_id',
+                tokenize='unicode61 remove_diacritics 2'
+            )
+        ''')
+    except sqlite3.OperationalError:
+        # Still counts as applied - Database checks for the table and falls back to LIKE searches without it
+        logging.warning("FTS5 is not available in this SQLite build, song searches will fall back to table scans")
+        return
+
+    # External content table, so it has to be kept in sync with Songs by hand
+    cursor.execute('''
+        CREATE TRIGGER SongsSearch_after_insert AFTER INSERT ON Songs BEGIN
+            INSERT INTO SongsSearch (rowid, song_name) VALUES (new.song_id, new.song_name);
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER SongsSearch_after_delete AFTER DELETE ON Songs BEGIN
+            INSERT INTO SongsSearch (SongsSearch, rowid, song_name) VALUES ('delete', old.song_id, old.song_name);
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER SongsSearch_after_update AFTER UPDATE OF song_name ON Songs BEGIN
+            INSERT INTO SongsSearch (SongsSearch, rowid, song_name) VALUES ('delete', old.song_id, old.song_name);
+            INSERT INTO SongsSearch (rowid, song_name) VALUES (new.song_id, new.song_name);
+        END
+    ''')
+
+    cursor.execute("INSERT INTO SongsSearch (SongsSearch) VALUES ('rebuild')")
+
+def _v4_song_length(cursor: sqlite3.Cursor) -> None:
+    # Left NULL for existing songs, they get filled in by a background backfill on startup
+    cursor.execute("ALTER TABLE Songs ADD COLUMN length_ms INTEGER")
+
+MIGRATIONS: Dict[int, Migration] = {
+    2: _v2_hot_path_indexes,
+    3: _v3_song_name_search,
+    4: _v4_song_length,
+}
+
+LATEST_VERSION = max(MIGRATIONS)
@@ -11,7 +11,24 @@ YOUTUBE_DL_COMMAND = "C:/music_player/youtube-dl.exe"
 FFMPEG_LOCATION = "C:/music_player/ffmpeg/bin/"
 
 PREFERRED_AUDIO_OUTPUT_ORDER = ["vlc", "pygame"]
+# Only used by the "simulated" speaker (no audio, for testing) - multiple of real time songs play at,
+# or 0 to have them finish as soon as they start
+SIMULATED_SPEAKER_SPEED = 1.0
+
+# Only used by the "pcm" speaker (decodes with ffmpeg and mixes in NumPy, needs numpy + sounddevice).
+# PCM_OUTPUT can be "null" to throw the audio away instead, for benchmarking without a sound card.
+PCM_OUTPUT = "sounddevice"
+PCM_SAMPLE_RATE = 44100
+PCM_BLOCK_FRAMES = 2048
+PCM_BUFFER_SECS = 2
+PCM_CROSSFADE_MS = 3000
 
 MAX_PARALLEL_DOWNLOADS = 1
 
-SONGS_PER_PAGE = 10
\ No newline at end of file
+# Widths (px) of the WebP thumbnail variants generated after each download
+THUMBNAIL_SIZES = [160, 480]
+THUMBNAIL_WORKERS = 1
+
+SONGS_PER_PAGE = 10
+
+SLOW_QUERY_THRESHOLD_MS = 100
\ No newline at end of file
@@ -0,0 +1,153 @@
+import argparse
+import io
+import json
+import logging
+import os
+import queue
+import random
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from typing import Any, Dict, List, Tuple
+from wsgiref.util import setup_testing_defaults
+
+from synthetic_library import FRAMES_PER_SECOND, SILENT_MP3_FRAME, WORDS
+
+# Runs the real player loop and webserver routes against the simulated speaker, with songs finishing
+# instantly (or at --speed times real time), while a few threads hammer the routes. Reports track
+# transitions per second, request latencies and how contended the song queue lock was:
+#
+#   python soak.py --songs 1000 --seconds 10 --http-threads 8
+
+SRC_DIR = os.path.dirname(os.path.abspath(__file__))
+
+def wsgi_request(app: Any, method: str, path: str) -> int:
+    (path_info, _, query_string) = path.partition("?")
+    environ: Dict[str, Any] = {
+        "REQUEST_METHOD": method,
+        "PATH_INFO": path_info,
+        "QUERY_STRING": query_string,
+        "wsgi.input": io.BytesIO(),
+    }
+    setup_testing_defaults(environ)
+
+    status: List[str] = []
+    body = app(environ, lambda s, headers, exc_info=None: status.append(s))
+    for _ in body:
+        pass
+    if hasattr(body, "close"):
+        body.close()
+
+    return int(status[0].split(" ", 1)[0])
+
+def run(args: argparse.Namespace, workdir: str) -> Dict[str, Any]:
+    import settings
+    settings.DATA_DIRECTORY = workdir
+    settings.MUSIC_DIR = os.path.join(workdir, "music")
+    settings.DATABASE_FILE = os.path.join(workdir, "database.db")
+    settings.PREFERRED_AUDIO_OUTPUT_ORDER = ["simulated"]
+    settings.SIMULATED_SPEAKER_SPEED = args.speed
+    os.makedirs(settings.MUSIC_DIR, exist_ok=True)
+
+    import bottle
+    from commands import Command
+    from database import database
+    from music_player import start_music_player
+    from mutex import Mutex
+    from song_queue import SongQueue
+    from speaker import speaker
+    from webserver import setup_routes
+
+    rng = random.Random(0)
+    song_ids = database.add_songs([
+        (" ".join(rng.choice(WORDS) for _ in range(3)).title(), f"vid{i:011d}", 0)
+        for i in range(args.songs)
+    ])
+    song_frames = SILENT_MP3_FRAME * (FRAMES_PER_SECOND * args.song_secs)
+    for i in range(args.songs):
+        with open(os.path.join(settings.MUSIC_DIR, f"vid{i:011d}.mp3"), "wb") as f:
+            f.write(song_frames)
+
+    event_queue: "queue.Queue[Command]" = queue.Queue(-1)
+    song_queue = Mutex(SongQueue())
+    setup_routes(event_queue, song_queue)
+    app = bottle.default_app()
+
+    requests: List[Tuple[str, str]] = [
+        ("GET", "/"),
+        ("GET", "/songs"),
+        ("GET", f"/songs?search={rng.choice(WORDS)}"),
+        ("GET", "/songs?page=3"),
+        ("POST", "/skip"),
+        ("POST", "/queue?id={song_id}"),
+    ]
+    latencies: Dict[str, List[float]] = {f"{method} {path}": [] for (method, path) in requests}
+    errors = 0
+    results_lock = threading.Lock()
+    deadline = time.perf_counter() + args.seconds
+
+    def hammer(seed: int) -> None:
+        nonlocal errors
+        thread_rng = random.Random(seed)
+        while time.perf_counter() < deadline:
+            (method, path) = thread_rng.choice(requests)
+            name = f"{method} {path}"
+            start = time.perf_counter()
+            status = wsgi_request(app, method, path.format(song_id=thread_rng.choice(song_ids)))
+            elapsed = time.perf_counter() - start
+
+            with results_lock:
+                latencies[name].append(elapsed)
+                if status >= 400:
+                    errors += 1
+
+    threading.Thread(target=start_music_player, args=(event_queue, song_queue), daemon=True).start()
+    threads = [threading.Thread(target=hammer, args=(i,), daemon=True) for i in range(args.http_threads)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    speaker_stats = speaker().stats()
+    database.close()
+
+    return {
+        "songs": args.songs,
+        "seconds": args.seconds,
+        "speaker": speaker_stats,
+        "transitions_per_sec": speaker_stats["songs_played"] / args.seconds,
+        "requests": {
+            name: {
+                "count": len(samples),
+                "per_sec": len(samples) / args.seconds,
+                "median_ms": statistics.median(samples) * 1000 if samples else 0.0,
+                "p95_ms": sorted(samples)[int(len(samples) * 0.95)] * 1000 if samples else 0.0,
+            }
+            for (name, samples) in latencies.items()
+        },
+        "request_errors": errors,
+        "song_queue_lock": song_queue.stats(),
+        "commands_pending": event_queue.qsize(),
+    }
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Soak test the player loop and webserver against the simulated speaker")
+    parser.add_argument("--songs", type=int, default=500)
+    parser.add_argument("--song-secs", type=int, default=1, help="Length of each generated song")
+    parser.add_argument("--seconds", type=float, default=10.0, help="How long to run for")
+    parser.add_argument("--http-threads", type=int, default=4)
+    parser.add_argument("--speed", type=float, default=0.0, help="Playback speed multiplier, 0 finishes songs instantly")
+    args = parser.parse_args()
+
+    logging.basicConfig(stream=sys.stderr, level=logging.WARNING, format="%(asctime)s:%(levelname)s:%(name)s:%(message)s")
+    # Templates and static files are found relative to here
+    os.chdir(SRC_DIR)
+
+    with tempfile.TemporaryDirectory(prefix="mp_soak_") as workdir:
+        json.dump(run(args, workdir), sys.stdout, indent=2)
+        print()
+
+if __name__ == "__main__":
+    main()
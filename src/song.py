@@ -1,11 +1,13 @@
-import base64
 from enum import Enum, auto
+import logging
 import os
-from typing import Any, Optional
+from typing import Any, Callable, Optional
 
 from mutagen.mp3 import MP3
 
 from database import database, Song as DbSong
+from settings import THUMBNAIL_SIZES
+from thumbnails import thumbnail_variant_path
 from utils import hours_mins_secs_to_human_readable, secs_to_hours_mins_secs
 
 class DownloadState(Enum):
@@ -15,18 +17,39 @@ class DownloadState(Enum):
 
 
 class Song:
-	def __init__(self, id: int, name: str, path: str, downloading: DownloadState):
+	def __init__(self, id: int, name: str, path: str, downloading: DownloadState, length_ms: Optional[int] = None):
 		self.id = id
 		self.name = name
 		self.path = path
-		self.downloading: DownloadState = downloading
+		self._download_state_listeners: "list[Callable[[], None]]" = []
+		self._downloading: DownloadState = downloading
 		self.download_percentage = 0.0 if downloading == DownloadState.Downloading else 1.0
+		# Only set while it's being downloaded - what cancelling the download goes by
+		self.downloading_video_id: Optional[str] = None
 
-		self._cached_length_secs: Optional[float] = None
+		self._cached_length_secs: Optional[float] = length_ms / 1000 if length_ms is not None and length_ms != UNREADABLE_LENGTH_MS else None
 		self._cached_start_time_ms: Optional[int] = None
 
+	@property
+	def downloading(self) -> DownloadState:
+		return self._downloading
+
+	@downloading.setter
+	def downloading(self, state: DownloadState) -> None:
+		self._downloading = state
+		for listener in list(self._download_state_listeners):
+			listener()
+
+	def add_download_state_listener(self, listener: Callable[[], None]) -> None:
+		self._download_state_listeners.append(listener)
+
+	def remove_download_state_listener(self, listener: Callable[[], None]) -> None:
+		if listener in self._download_state_listeners:
+			self._download_state_listeners.remove(listener)
+
 	@property
 	def length_secs(self) -> float:
+		# Normally stored in the DB - only songs that haven't been backfilled yet need the file probing
 		if self._cached_length_secs is None:
 			audio = MP3(self.path)
 			self._cached_length_secs = audio.info.length
@@ -50,38 +73,71 @@ class Song:
 		
 		return jpg
 
+	def thumbnail_path_for(self, width: int) -> str:
+		# The smallest pre-shrunk variant that's still at least as wide as what's being drawn, falling
+		# back to the full size original until the variants have been generated
+		for size in sorted(THUMBNAIL_SIZES):
+			if size >= width:
+				variant = thumbnail_variant_path(self.path, size)
+				if os.path.isfile(variant):
+					return variant
+
+		return self.thumbnail_path
+
 	def length_human_readable(self) -> str:
 		return hours_mins_secs_to_human_readable(secs_to_hours_mins_secs(self.length_secs))
 
-	def thumbnail_base64(self) -> str:
-		try:
-			with open(self.thumbnail_path, "rb") as f:
-				data = f.read()
-		except FileNotFoundError:
-			with open("./static/questionMark.png", "rb") as f:
-				data = f.read()
-
-		b64 = base64.b64encode(data).decode("utf-8")
+	def thumbnail_url(self, width: Optional[int] = None) -> str:
+		if width is None:
+			return f"/thumbnail/{self.id}"
 
-		return b64
+		return f"/thumbnail/{self.id}?width={width}"
 
 	def set_download_percentage(self, val: float) -> None:
 		self.download_percentage = val
 
 	@staticmethod
 	def from_db_song(s: DbSong, downloadState: DownloadState) -> "Song":
-		return Song(s.id, s.name, s.path(), downloadState)
+		return Song(s.id, s.name, s.path(), downloadState, s.length_ms)
 
 	def __eq__(self, other: Any) -> bool:
 		return isinstance(other, Song) and self.path == other.path
 
+# Stored for songs whose file couldn't be read, so the backfill doesn't keep retrying them
+UNREADABLE_LENGTH_MS = -1
+
+def probe_length_ms(path: str) -> Optional[int]:
+	try:
+		return round(MP3(path).info.length * 1000)
+	except Exception:
+		# Missing files and bad headers both come out as mutagen's MutagenError, which it doesn't export
+		logging.debug(f"Could not read the length of {path}")
+		return None
+
+def backfill_song_lengths(batch_size: int = 100) -> None:
+	logging.info("Backfilling lengths for songs that don't have one stored")
+	pending: "list[tuple[int, int]]" = []
+	updated = 0
+
+	for s in database.iter_songs(without_length=True):
+		# Stored either way - a file that can't be read now won't be any more readable next boot
+		length_ms = probe_length_ms(s.path())
+		pending.append((s.id, UNREADABLE_LENGTH_MS if length_ms is None else length_ms))
+		if len(pending) >= batch_size:
+			database.set_song_lengths(pending)
+			updated += len(pending)
+			pending = []
+
+	if pending:
+		database.set_song_lengths(pending)
+		updated += len(pending)
+
+	logging.info(f"Backfilled lengths for {updated} song(s)")
+
 class NullSong(Song):
 	def __init__(self):
 		super().__init__(-1, "<NULL>", "<NULL>", DownloadState.Downloaded)
 		# Don't let the length_secs property try to read this non-existant file
 		self._cached_length_secs = 0
 
-	def thumbnail_base64(self) -> str:
-		return ""
-
 # pyright: reportMissingTypeStubs=false
\ No newline at end of file
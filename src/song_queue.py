@@ -1,64 +1,161 @@
+from collections import deque
 import logging
+import time
+from typing import NamedTuple, Optional, Tuple
 
-from playing_song import NullPlayingSong, PlayingSong
+from playing_song import NullPlayingSong, PlayingSong, PlayingState
 from playlist import AllAvailableCachedSongsPlaylist, FilePlaylist, Playlist
-from song import DownloadState, Song
+from song import Song
 from database import database
+from speaker import speaker
+from up_next_queue import UpNextQueue
+from utils import hours_mins_secs_to_human_readable, secs_to_hours_mins_secs
 
 MAX_RECENTLY_PLAYED_SONGS = 100
 
+class SongQueueSnapshot(NamedTuple):
+	# Everything the web pages show, as of the last change to the queue. A new one is built on every
+	# change rather than updating this one, so readers never need the song queue's lock.
+	version: int
+	current_song: Song
+	playing_state: PlayingState
+	elapsed_secs: float
+	elapsed_at: float # time.monotonic() when elapsed_secs was read
+	up_next: Tuple[Song, ...]
+	playlist_id: int
+	playlist_shuffle: bool
+	playlists: Tuple[Tuple[int, str], ...]
+	volume: float
+	vol_min_max_step: Tuple[float, float, float]
+
+	def current_elapsed_time_secs(self) -> float:
+		if self.playing_state != PlayingState.Playing:
+			return self.elapsed_secs
+
+		elapsed = self.elapsed_secs + time.monotonic() - self.elapsed_at
+		return min(elapsed, self.current_song.length_secs)
+
+	def current_elapsed_time_human_readable(self) -> str:
+		return hours_mins_secs_to_human_readable(secs_to_hours_mins_secs(round(self.current_elapsed_time_secs())))
+
 
 class SongQueue:
 	def __init__(self):
-		self.up_next: list[Song] = []
+		self.up_next = UpNextQueue()
 		self.currently_playing: PlayingSong = NullPlayingSong()
-		self.recently_played: list[Song] = []
+		self.recently_played: "deque[Song]" = deque(maxlen=MAX_RECENTLY_PLAYED_SONGS)
 
 		self.default_all_playlist = AllAvailableCachedSongsPlaylist()
 		self.playlist: Playlist = self.default_all_playlist
+		# Taken from the playlist early so it can be preloaded, but only played if nothing gets queued first
+		self.playlist_next: Optional[Song] = None
+
+		self._playlists: Tuple[Tuple[int, str], ...] = ()
+		self._up_next_snapshot: Tuple[Song, ...] = ()
+		self._snapshot_version = 0
+		self.snapshot: SongQueueSnapshot
+		self._refresh_playlists()
+		self.publish()
 
 	def queue_song(self, song: Song) -> None:
 		self.up_next.append(song)
+		self.preload_next_song()
+		self.publish(up_next_changed=True)
 
 	def queue_song_priority(self, song: Song) -> None:
-		self.up_next.insert(0, song)
+		self.up_next.appendleft(song)
+		self.preload_next_song()
+		self.publish(up_next_changed=True)
 
 	def play(self) -> None:
 		self.currently_playing.play()
+		self.publish()
 
 	def pause(self) -> None:
 		self.currently_playing.pause()
+		self.publish()
+
+	def set_volume(self, volume: float) -> None:
+		speaker().set_volume(volume)
+		self.publish()
+
+	def publish(self, up_next_changed: bool = False) -> None:
+		# Swapping the attribute over is atomic, so whoever reads it gets either the old or new snapshot
+		if up_next_changed:
+			self._up_next_snapshot = tuple(self.up_next)
+
+		self._snapshot_version += 1
+		self.snapshot = SongQueueSnapshot(
+			version=self._snapshot_version,
+			current_song=self.currently_playing.song,
+			playing_state=self.currently_playing.playing_state,
+			elapsed_secs=self.currently_playing.current_elapsed_time_secs() or 0.0,
+			elapsed_at=time.monotonic(),
+			up_next=self._up_next_snapshot,
+			playlist_id=self.playlist.id,
+			playlist_shuffle=self.playlist.shuffle,
+			playlists=self._playlists,
+			volume=speaker().get_volume(),
+			vol_min_max_step=speaker().volume_min_max_step()
+		)
+
+	def _refresh_playlists(self) -> None:
+		self._playlists = tuple((p.id, p.name) for p in FilePlaylist.all_available_playlists())
 
 	def current_song_finished(self) -> bool:
 		return self.currently_playing.is_finished()
 
-	def next_song(self):
-		song = self._extract_next_song_from_up_next()
+	def next_song(self, skip: int = 1):
+		# Skipping over a song counts as having (briefly) played it, the same as skipping one at a time
+		# would - so a coalesced multi-skip leaves the same history behind
 		self._copy_currently_playing_to_recently_played()
+		for _ in range(skip - 1):
+			skipped = self._extract_next_song_from_up_next()
+			logging.info(f"Skipping over {skipped.name}")
+			self.recently_played.append(skipped)
+
+		song = self._extract_next_song_from_up_next()
 
 		self.currently_playing = PlayingSong(song)
 		self.currently_playing.play()
-		self.currently_playing.skip_to_overridden_start()
+		self.preload_next_song()
+		self.publish(up_next_changed=True)
+
+	def peek_next_song(self) -> Song:
+		song = self.up_next.peek_first_ready()
+		if song is not None:
+			return song
+
+		if self.playlist_next is None:
+			self.playlist_next = self._random_available_song()
+
+		return self.playlist_next
+
+	def preload_next_song(self) -> None:
+		song = self.peek_next_song()
+		if song.id == -1:
+			return
+
+		try:
+			speaker().preload(song.path, song.start_time)
+		except:
+			# Not fatal, it'll just get loaded the slow way when its turn comes
+			logging.exception(f"Could not preload {song.name} ({song.path})")
 
 	def _copy_currently_playing_to_recently_played(self):
 		self.recently_played.append(self.currently_playing.song)
-		self.recently_played = self.recently_played[-MAX_RECENTLY_PLAYED_SONGS:]
 
 	def _extract_next_song_from_up_next(self):
 		self._clear_errored_downloads()
 		
 		logging.info(f"Finding next song in queue of {len(self.up_next)} song(s)")
-		for song in self.up_next:
-			if song.downloading == DownloadState.Downloaded:
-				logging.info(f"Found song available to play: {song.name} ({song.path})")
-				self.up_next.remove(song)
-				break
+		song = self.up_next.pop_first_ready()
+		if song is not None:
+			logging.info(f"Found song available to play: {song.name} ({song.path})")
 		else:
-			song = None
-
-		if song is None:
 			logging.info("No songs queued/ready, getting next song from playlist")
-			song = self._random_available_song()
+			song = self.playlist_next or self._random_available_song()
+			self.playlist_next = None
 			logging.info(f"Selected song is {song.name}")
 
 		return song
@@ -67,14 +164,13 @@ class SongQueue:
 		return self.playlist.get_next()
 
 	def _clear_errored_downloads(self) -> None:
-		errored_songs = [s for s in self.up_next if s.downloading == DownloadState.Error]
+		errored_songs = self.up_next.remove_errored()
 		if len(errored_songs) == 0:
 			return
 
-		logging.info(f"Removing {len(errored_songs)} song(s) that errored downloading")
-		for to_remove in errored_songs:
-			logging.debug(f"Removing {to_remove.name} (failed to download)")
-			self.up_next.remove(to_remove)
+		logging.info(f"Removed {len(errored_songs)} song(s) that errored downloading")
+		for removed in errored_songs:
+			logging.debug(f"Removed {removed.name} (failed to download)")
 
 	def change_playlist(self, id: int, shuffle: bool) -> None:
 		if id != self.playlist.id:
@@ -89,5 +185,12 @@ class SongQueue:
 					return
 				self.playlist = FilePlaylist(pl.id, pl.name)
 
+			self.playlist_next = None
+
 		logging.info(f"Setting playlists shuffle state to {shuffle}")
-		self.playlist.shuffle = shuffle
\ No newline at end of file
+		self.playlist.shuffle = shuffle
+		self.preload_next_song()
+
+		# Playlists only get created just before being changed to, so this is when the list can change
+		self._refresh_playlists()
+		self.publish()
\ No newline at end of file
@@ -1,10 +1,26 @@
-from typing import Tuple
+from typing import Any, Callable, Dict, Optional, Tuple
 
 
 class AbstractSpeaker:
-    def load(self, filename: str) -> None:
+    _on_finished: Optional[Callable[[], None]] = None
+
+    def set_on_finished(self, callback: Optional[Callable[[], None]]) -> None:
+        # Called whenever a song plays through to the end. May be called from a thread belonging to the
+        # speaker, so it should hand off rather than do anything heavy (or touch the speaker) itself.
+        self._on_finished = callback
+
+    def _notify_finished(self) -> None:
+        if self._on_finished is not None:
+            self._on_finished()
+
+    def load(self, filename: str, start_ms: int = 0) -> None:
         raise NotImplementedError()
 
+    def preload(self, filename: str, start_ms: int = 0) -> None:
+        # Called with whatever is expected to be load()ed next, while the current song is still going,
+        # so speakers that can get a head start on opening/decoding it should. Optional.
+        pass
+
     def play(self) -> None:
         raise NotImplementedError()
 
@@ -30,4 +46,7 @@ class AbstractSpeaker:
         raise NotImplementedError()
 
     def volume_min_max_step(self) -> Tuple[float, float, float]:
-        raise NotImplementedError()
\ No newline at end of file
+        raise NotImplementedError()
+
+    def stats(self) -> Dict[str, Any]:
+        return {}
\ No newline at end of file
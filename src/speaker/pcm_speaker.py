@@ -0,0 +1,386 @@
+import logging
+import threading
+import time
+from subprocess import DEVNULL, PIPE, Popen
+from typing import Any, Callable, Dict, Optional, Tuple
+
+import numpy as np
+
+from .abstract_speaker import AbstractSpeaker
+
+from settings import PCM_BLOCK_FRAMES, PCM_BUFFER_SECS, PCM_CROSSFADE_MS, PCM_OUTPUT, PCM_SAMPLE_RATE
+from song import probe_length_ms
+from utils import FFMPEG
+
+# Decodes songs itself (ffmpeg piping raw PCM into a ring buffer per song) and does the mixing in NumPy,
+# a fixed size block at a time, with the audio device pulling blocks through a callback. Doing it here
+# rather than handing files to VLC/pygame is what makes crossfading between songs possible.
+
+CHANNELS = 2
+BYTES_PER_FRAME = CHANNELS * 2 # s16le
+
+class _RingBuffer:
+    def __init__(self, frames: int) -> None:
+        self._data = np.zeros((frames, CHANNELS), dtype=np.float32)
+        self._capacity = frames
+        # Total frames ever written/read - the positions in _data are these modulo the capacity
+        self._written = 0
+        self._read = 0
+        self._cond = threading.Condition()
+        self.eof = False
+        self.closed = False
+
+    @property
+    def available(self) -> int:
+        return self._written - self._read
+
+    def write(self, frames: np.ndarray) -> bool:
+        # Blocks the decoder while the buffer is full, so it never gets more than PCM_BUFFER_SECS ahead
+        offset = 0
+        while offset < len(frames):
+            with self._cond:
+                while not self.closed and self.available == self._capacity:
+                    self._cond.wait()
+                if self.closed:
+                    return False
+
+                count = min(len(frames) - offset, self._capacity - self.available)
+                self._copy_in(frames[offset:offset + count])
+                self._written += count
+                offset += count
+
+        return True
+
+    def read_into(self, out: np.ndarray) -> int:
+        # Called from the audio callback, so never waits - whatever's there is all there is
+        with self._cond:
+            count = min(len(out), self.available)
+            start = self._read % self._capacity
+            first = min(count, self._capacity - start)
+            out[:first] = self._data[start:start + first]
+            out[first:count] = self._data[:count - first]
+            self._read += count
+            self._cond.notify_all()
+
+        return count
+
+    def finish(self) -> None:
+        with self._cond:
+            self.eof = True
+
+    def close(self) -> None:
+        with self._cond:
+            self.closed = True
+            self._cond.notify_all()
+
+    def _copy_in(self, frames: np.ndarray) -> None:
+        start = self._written % self._capacity
+        first = min(len(frames), self._capacity - start)
+        self._data[start:start + first] = frames[:first]
+        self._data[:len(frames) - first] = frames[first:]
+
+class _Track:
+    def __init__(self, filename: str, start_ms: int) -> None:
+        self.key = (filename, start_ms)
+        self.filename = filename
+        self.pos_frames = start_ms * PCM_SAMPLE_RATE // 1000
+        self.total_frames = _length_frames(filename)
+        # Started by the speaker itself to crossfade into, and not yet load()ed by the queue
+        self.auto_started = False
+
+        self._ring = _RingBuffer(int(PCM_BUFFER_SECS * PCM_SAMPLE_RATE))
+        self._process = Popen([
+            FFMPEG,
+            "-loglevel", "error",
+            "-ss", f"{start_ms / 1000}",
+            "-i", filename,
+            "-f", "s16le",
+            "-ac", str(CHANNELS),
+            "-ar", str(PCM_SAMPLE_RATE),
+            "-"
+        ], stdin=DEVNULL, stdout=PIPE)
+        threading.Thread(target=self._decode, name="PcmDecoder", daemon=True).start()
+
+    @property
+    def finished(self) -> bool:
+        return self._ring.eof and self._ring.available == 0
+
+    @property
+    def pos_ms(self) -> int:
+        return self.pos_frames * 1000 // PCM_SAMPLE_RATE
+
+    def read_into(self, out: np.ndarray) -> int:
+        count = self._ring.read_into(out)
+        self.pos_frames += count
+        return count
+
+    def close(self) -> None:
+        self._ring.close()
+        if self._process.poll() is None:
+            self._process.kill()
+
+    def _decode(self) -> None:
+        stdout = self._process.stdout
+        assert stdout is not None
+        scale = np.float32(1 / 32768)
+
+        try:
+            while True:
+                data = stdout.read(PCM_BLOCK_FRAMES * BYTES_PER_FRAME)
+                if not data:
+                    break
+
+                usable = len(data) - len(data) % BYTES_PER_FRAME
+                frames = np.frombuffer(data[:usable], dtype="<i2").reshape(-1, CHANNELS).astype(np.float32)
+                frames *= scale
+                if not self._ring.write(frames):
+                    break
+        except:
+            logging.exception(f"Error decoding {self.filename}")
+        finally:
+            self._ring.finish()
+            stdout.close()
+            self._process.wait()
+
+def _length_frames(filename: str) -> Optional[int]:
+    length_ms = probe_length_ms(filename)
+    if length_ms is None:
+        logging.debug(f"{filename} won't be crossfaded out of, its length is unknown")
+        return None
+    return length_ms * PCM_SAMPLE_RATE // 1000
+
+class PcmSpeaker(AbstractSpeaker):
+    def __init__(self) -> None:
+        self.__lock = threading.Lock()
+        self.__current: Optional[_Track] = None
+        self.__fading: Optional[_Track] = None
+        self.__preloaded: Optional[_Track] = None
+        self.__playing = False
+        self.__volume = 1.0
+
+        # Everything the audio callback touches is allocated up front, nothing per block
+        self.__crossfade_frames = PCM_CROSSFADE_MS * PCM_SAMPLE_RATE // 1000
+        self.__fade_in = np.ones(self.__crossfade_frames + PCM_BLOCK_FRAMES, dtype=np.float32)
+        self.__fade_in[:self.__crossfade_frames] = np.linspace(0, 1, self.__crossfade_frames, endpoint=False, dtype=np.float32)
+        self.__fade_out = 1 - self.__fade_in
+        self.__fade_pos = 0
+        self.__scratch = np.zeros((PCM_BLOCK_FRAMES, CHANNELS), dtype=np.float32)
+
+        self.blocks = 0
+        self.underruns = 0
+        self.device_underruns = 0
+        self.render_secs = 0.0
+        self.max_render_secs = 0.0
+
+    def load(self, filename: str, start_ms: int = 0) -> None:
+        with self.__lock:
+            current = self.__current
+            if current and current.auto_started and current.key == (filename, start_ms):
+                # Already crossfading in - nothing to do but own up to it
+                current.auto_started = False
+                return
+
+            preloaded = self.__preloaded
+            if preloaded and preloaded.key == (filename, start_ms):
+                self.__preloaded = None
+            else:
+                preloaded = None
+
+        track = preloaded or _Track(filename, start_ms)
+
+        with self.__lock:
+            old = self.__current
+            self.__current = track
+            self.__playing = False
+
+        if old:
+            old.close()
+
+    def preload(self, filename: str, start_ms: int = 0) -> None:
+        with self.__lock:
+            if self.__preloaded and self.__preloaded.key == (filename, start_ms):
+                return
+
+        track = _Track(filename, start_ms)
+
+        with self.__lock:
+            old = self.__preloaded
+            self.__preloaded = track
+
+        if old:
+            old.close()
+
+    def play(self) -> None:
+        with self.__lock:
+            self.__playing = True
+
+    def pause(self) -> None:
+        with self.__lock:
+            self.__playing = False
+
+    def unpause(self) -> None:
+        self.play()
+
+    def get_busy(self) -> bool:
+        with self.__lock:
+            return self.__playing and self.__current is not None and not self.__current.auto_started
+
+    def get_pos(self) -> int:
+        with self.__lock:
+            return self.__current.pos_ms if self.__current else 0
+
+    def set_pos(self, ms: int) -> None:
+        with self.__lock:
+            current = self.__current
+        if current is None:
+            return
+
+        track = _Track(current.filename, ms)
+        track.auto_started = current.auto_started
+
+        with self.__lock:
+            self.__current = track
+        current.close()
+
+    def get_volume(self) -> float:
+        return self.__volume
+
+    def set_volume(self, volume: float) -> None:
+        self.__volume = min(2.0, max(0.0, volume))
+
+    def volume_min_max_step(self) -> Tuple[float, float, float]:
+        return (0.0, 2.0, 0.1)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "output": PCM_OUTPUT,
+            "blocks": self.blocks,
+            "underruns": self.underruns,
+            "device_underruns": self.device_underruns,
+            "mean_render_us": (self.render_secs / self.blocks) * 1_000_000 if self.blocks else 0.0,
+            "max_render_us": self.max_render_secs * 1_000_000,
+            "block_budget_us": PCM_BLOCK_FRAMES / PCM_SAMPLE_RATE * 1_000_000,
+        }
+
+    def render(self, out: np.ndarray) -> None:
+        start = time.perf_counter()
+        song_finished = False
+        closing: "list[_Track]" = []
+
+        with self.__lock:
+            current = self.__current
+            if not self.__playing or current is None:
+                out.fill(0)
+            else:
+                count = current.read_into(out)
+                if count < len(out):
+                    out[count:] = 0
+                    if current.finished:
+                        closing.append(current)
+                        self.__current = None
+                        song_finished = not current.auto_started
+                    else:
+                        self.underruns += 1
+
+                if self.__fading is not None:
+                    self._mix_fading_locked(out, closing)
+
+                if self.__current is not None and self._should_crossfade_locked(self.__current):
+                    song_finished = self._start_crossfade_locked()
+
+                out *= np.float32(self.__volume)
+                np.clip(out, -1, 1, out=out)
+
+        for track in closing:
+            track.close()
+        if song_finished:
+            self._notify_finished()
+
+        elapsed = time.perf_counter() - start
+        self.blocks += 1
+        self.render_secs += elapsed
+        self.max_render_secs = max(self.max_render_secs, elapsed)
+
+    def _mix_fading_locked(self, out: np.ndarray, closing: "list[_Track]") -> None:
+        fading = self.__fading
+        assert fading is not None
+        frames = len(out)
+        scratch = self.__scratch[:frames]
+
+        count = fading.read_into(scratch)
+        scratch[count:] = 0
+
+        ramp = slice(self.__fade_pos, self.__fade_pos + frames)
+        out *= self.__fade_in[ramp, np.newaxis]
+        scratch *= self.__fade_out[ramp, np.newaxis]
+        out += scratch
+
+        self.__fade_pos += frames
+        if self.__fade_pos >= self.__crossfade_frames or fading.finished:
+            closing.append(fading)
+            self.__fading = None
+
+    def _should_crossfade_locked(self, current: _Track) -> bool:
+        return (
+            self.__crossfade_frames > 0
+            and self.__fading is None
+            and self.__preloaded is not None
+            and not current.auto_started
+            and current.total_frames is not None
+            and current.pos_frames >= current.total_frames - self.__crossfade_frames
+        )
+
+    def _start_crossfade_locked(self) -> bool:
+        # The outgoing song counts as finished from here, so the queue moves on (and load()s the song
+        # that's already fading in) while it's still audible
+        incoming = self.__preloaded
+        assert incoming is not None
+        incoming.auto_started = True
+
+        self.__fading = self.__current
+        self.__current = incoming
+        self.__preloaded = None
+        self.__fade_pos = 0
+        return True
+
+class _NullSink:
+    # Throws the audio away at the rate a sound card would take it, for benchmarking without one
+    def __init__(self, render: Callable[[np.ndarray], None]) -> None:
+        self._render = render
+        self._block = np.zeros((PCM_BLOCK_FRAMES, CHANNELS), dtype=np.float32)
+        threading.Thread(target=self._run, name="PcmNullSink", daemon=True).start()
+
+    def _run(self) -> None:
+        block_secs = PCM_BLOCK_FRAMES / PCM_SAMPLE_RATE
+        next_block = time.perf_counter()
+
+        while True:
+            self._render(self._block)
+            next_block += block_secs
+            time.sleep(max(0.0, next_block - time.perf_counter()))
+
+def _open_output(speaker: PcmSpeaker) -> Any:
+    if PCM_OUTPUT == "null":
+        return _NullSink(speaker.render)
+
+    import sounddevice as sd
+
+    def callback(outdata: np.ndarray, frames: int, time_info: Any, status: Any) -> None:
+        if status.output_underflow:
+            speaker.device_underruns += 1
+        speaker.render(outdata)
+
+    stream = sd.OutputStream(
+        samplerate=PCM_SAMPLE_RATE,
+        channels=CHANNELS,
+        dtype="float32",
+        blocksize=PCM_BLOCK_FRAMES,
+        callback=callback
+    )
+    stream.start()
+    return stream
+
+speaker = PcmSpeaker()
+_output = _open_output(speaker)
+
+# pyright: reportMissingTypeStubs=false, reportUnknownVariableType=false, reportUnknownMemberType=false, reportUnknownArgumentType=false
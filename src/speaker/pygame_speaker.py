@@ -1,6 +1,10 @@
+import io
+import logging
 import os
+import threading
+import time
 os.environ["PYGAME_HIDE_SUPPORT_PROMPT"] = "hide" # Stop pygame printing things on import
-from typing import Tuple
+from typing import Optional, Tuple
 
 from .abstract_speaker import AbstractSpeaker
 
@@ -12,21 +16,69 @@ pygame.mixer.init()
 music = Mutex(pygame.mixer.music)
 
 class PygameSpeaker(AbstractSpeaker):
-    def load(self, filename: str) -> None:
+    # mixer.music's end event goes through SDL's event queue, which is only safe to use from the thread
+    # that set it up - so instead a thread polls for the music having stopped without being paused
+    _poll_secs = 0.25
+
+    def __init__(self) -> None:
+        self.__start_ms = 0
+        # Set by play()/unpause() and cleared by pause()/load(), so only a song running out counts as finishing
+        self.__playing = False
+        # (filename, start_ms, file contents) - mixer.music can only hold one song at a time, so the
+        # best that can be done ahead of time is getting the next one off the disk
+        self.__preloaded: Optional[Tuple[str, int, bytes]] = None
+
+        threading.Thread(target=self._watch_for_song_end, name="PygameSongEnd", daemon=True).start()
+
+    def _watch_for_song_end(self) -> None:
+        while True:
+            time.sleep(self._poll_secs)
+            try:
+                with music.acquire() as m:
+                    finished = self.__playing and not m.value.get_busy()
+                    if finished:
+                        self.__playing = False
+
+                if finished:
+                    self._notify_finished()
+            except:
+                logging.exception("Error while checking whether the song has finished")
+
+    def load(self, filename: str, start_ms: int = 0) -> None:
+        preloaded = self.__preloaded
+        self.__preloaded = None
+
         with music.acquire() as m:
-            m.value.load(filename)
+            if preloaded and preloaded[:2] == (filename, start_ms):
+                m.value.load(io.BytesIO(preloaded[2]), os.path.splitext(filename)[1].lstrip("."))
+            else:
+                m.value.load(filename)
+
+            self.__start_ms = start_ms
+            self.__playing = False
+
+    def preload(self, filename: str, start_ms: int = 0) -> None:
+        if self.__preloaded and self.__preloaded[0] == filename:
+            self.__preloaded = (filename, start_ms, self.__preloaded[2])
+            return
+
+        with open(filename, "rb") as f:
+            self.__preloaded = (filename, start_ms, f.read())
 
     def play(self) -> None:
         with music.acquire() as m:
-            m.value.play()
+            m.value.play(start=self.__start_ms / 1000)
+            self.__playing = True
 
     def pause(self) -> None:
         with music.acquire() as m:
             m.value.pause()
+            self.__playing = False
 
     def unpause(self) -> None:
         with music.acquire() as m:
             m.value.unpause()
+            self.__playing = True
 
     def get_busy(self) -> bool:
         with music.acquire() as m:
@@ -34,7 +86,9 @@ class PygameSpeaker(AbstractSpeaker):
 
     def get_pos(self) -> int:
         with music.acquire() as m:
-            return m.value.get_pos()
+            pos = m.value.get_pos()
+            # get_pos() only counts from when play() was called, not from the start of the song
+            return pos + self.__start_ms if pos >= 0 else pos
 
     def set_pos(self, ms: int):
         with music.acquire() as m:
@@ -0,0 +1,150 @@
+import logging
+import threading
+import time
+from typing import Any, Dict, Optional, Tuple
+
+from .abstract_speaker import AbstractSpeaker
+
+from settings import SIMULATED_SPEAKER_SPEED
+from song import probe_length_ms
+
+class SimulatedSpeaker(AbstractSpeaker):
+    # Plays nothing - songs just run against a virtual clock, so the player loop, queue and webserver
+    # can be driven without any audio hardware. The clock runs at `speed` times real time, or with a
+    # speed of 0 every song finishes as soon as it's played. advance() moves it along by hand.
+    _unknown_length_ms = 3 * 60 * 1000
+
+    def __init__(self, speed: float) -> None:
+        self.speed = speed
+        self.__clock = threading.Condition()
+        self.__volume = 1.0
+        self.__lengths_ms: Dict[str, int] = {}
+
+        self.__filename = ""
+        self.__length_ms = 0
+        # Virtual position as of __anchor (a real time.perf_counter()), or just the position if stopped/paused
+        self.__pos_ms = 0
+        self.__anchor: Optional[float] = None
+        self.__finish_notified = False
+
+        self.songs_played = 0
+        self.songs_finished = 0
+        self.virtual_ms_played = 0
+
+        threading.Thread(target=self._run_clock, name="SimulatedSpeakerClock", daemon=True).start()
+
+    def load(self, filename: str, start_ms: int = 0) -> None:
+        length_ms = self._length_ms(filename)
+
+        with self.__clock:
+            self._stop_locked()
+            self.__filename = filename
+            self.__length_ms = length_ms
+            self.__pos_ms = min(start_ms, length_ms)
+
+    def _length_ms(self, filename: str) -> int:
+        length_ms = self.__lengths_ms.get(filename)
+        if length_ms is None:
+            length_ms = probe_length_ms(filename)
+            if length_ms is None:
+                logging.debug(f"Pretending {filename} is {self._unknown_length_ms}ms long")
+                length_ms = self._unknown_length_ms
+
+            self.__lengths_ms[filename] = length_ms
+
+        return length_ms
+
+    def play(self) -> None:
+        with self.__clock:
+            self.songs_played += 1
+            self._start_locked()
+
+    def pause(self) -> None:
+        with self.__clock:
+            self._stop_locked()
+
+    def unpause(self) -> None:
+        with self.__clock:
+            self._start_locked()
+
+    def get_busy(self) -> bool:
+        with self.__clock:
+            return self.__anchor is not None and self._pos_locked() < self.__length_ms
+
+    def get_pos(self) -> int:
+        with self.__clock:
+            return self._pos_locked()
+
+    def set_pos(self, ms: int) -> None:
+        with self.__clock:
+            playing = self.__anchor is not None
+            self._stop_locked()
+            self.__pos_ms = max(0, min(ms, self.__length_ms))
+            if playing:
+                self._start_locked()
+
+    def advance(self, ms: int) -> None:
+        with self.__clock:
+            if self.__anchor is not None:
+                self.set_pos(self._pos_locked() + ms)
+
+    def get_volume(self) -> float:
+        return self.__volume
+
+    def set_volume(self, volume: float) -> None:
+        self.__volume = min(1.0, max(0.0, volume))
+
+    def volume_min_max_step(self) -> Tuple[float, float, float]:
+        return (0.0, 1.0, 0.1)
+
+    def stats(self) -> Dict[str, Any]:
+        with self.__clock:
+            return {
+                "speed": self.speed,
+                "songs_played": self.songs_played,
+                "songs_finished": self.songs_finished,
+                "virtual_ms_played": self.virtual_ms_played,
+            }
+
+    def _pos_locked(self) -> int:
+        if self.__anchor is None:
+            return self.__pos_ms
+        if self.speed <= 0:
+            return self.__length_ms
+
+        elapsed_ms = (time.perf_counter() - self.__anchor) * 1000 * self.speed
+        return min(self.__length_ms, self.__pos_ms + int(elapsed_ms))
+
+    def _start_locked(self) -> None:
+        if self.__anchor is None:
+            self.__anchor = time.perf_counter()
+            self.__finish_notified = False
+            self.__clock.notify_all()
+
+    def _stop_locked(self) -> None:
+        if self.__anchor is not None:
+            pos_ms = self._pos_locked()
+            self.virtual_ms_played += pos_ms - self.__pos_ms
+            self.__pos_ms = pos_ms
+            self.__anchor = None
+            self.__clock.notify_all()
+
+    def _run_clock(self) -> None:
+        while True:
+            with self.__clock:
+                if self.__anchor is None or self.__finish_notified:
+                    self.__clock.wait()
+                    continue
+
+                remaining_ms = self.__length_ms - self._pos_locked()
+                if remaining_ms > 0:
+                    self.__clock.wait(remaining_ms / 1000 / self.speed)
+                    continue
+
+                self.__finish_notified = True
+                self.songs_finished += 1
+
+            # Outside the lock, the callback is going to want to load the next song
+            self._notify_finished()
+
+speaker = SimulatedSpeaker(SIMULATED_SPEAKER_SPEED)
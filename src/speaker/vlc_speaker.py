@@ -1,110 +1,117 @@
 import time
-import logging
-        
-from typing import Optional, Tuple
+from collections import OrderedDict
+
+from typing import Tuple
 from .abstract_speaker import AbstractSpeaker
 
 from mutex import Mutex
 
-from vlc import MediaPlayer
+from vlc import Event, EventType, Instance, Media, MediaParseFlag, MediaPlayer
 
 class VlcSpeaker(AbstractSpeaker):
+    # One instance and player for the life of the process - tracks are swapped with set_media() rather
+    # than tearing the player (and its audio output) down and building a new one each time
+    _media_cache_size = 4
+
     def __init__(self) -> None:
-        self.__track: Mutex[Optional[MediaPlayer]] = Mutex(None)
+        self.__instance = Instance()
+        self.__player: Mutex[MediaPlayer] = Mutex(self.__instance.media_player_new())
         self.__volume: float = 1.0
-        self.__current_playing_filename: str = ""
 
-        self.__pause_state: Optional[Tuple[int, str]] = None
+        with self.__player.acquire() as player:
+            events = player.value.event_manager()
+            events.event_attach(EventType.MediaPlayerEndReached, self._on_end_reached)
+            # A missing or undecodable file never reaches the end, this is all that's heard about it
+            events.event_attach(EventType.MediaPlayerEncounteredError, self._on_end_reached)
 
-    def load(self, filename: str) -> None:
-        with self.__track.acquire() as track:
-            if track.value:
-                track.value.release()
+        # (filename, start_ms) -> Media, so a preloaded song is already parsed by the time it's loaded
+        self.__media: "OrderedDict[Tuple[str, int], Media]" = OrderedDict()
 
-            track.replace_value(MediaPlayer(filename))
-            self.__current_playing_filename = filename
+    def load(self, filename: str, start_ms: int = 0) -> None:
+        with self.__player.acquire() as player:
+            player.value.set_media(self._media_locked(filename, start_ms))
 
-    def play(self) -> None:
-        self.__pause_state = None
+    def preload(self, filename: str, start_ms: int = 0) -> None:
+        with self.__player.acquire():
+            if (filename, start_ms) in self.__media:
+                return
+
+            media = self._media_locked(filename, start_ms)
+            # Parsed in the background, so by the time it's needed the demuxing is already done
+            media.parse_with_options(MediaParseFlag.local, 0)
+
+    def _media_locked(self, filename: str, start_ms: int) -> Media:
+        key = (filename, start_ms)
+        media = self.__media.get(key)
+        if media is not None:
+            self.__media.move_to_end(key)
+            return media
+
+        media = self.__instance.media_new(filename)
+        if start_ms > 0:
+            # Starting from the offset rather than seeking once playing means the start never gets heard
+            media.add_option(f"start-time={start_ms / 1000}")
+
+        self.__media[key] = media
+        while len(self.__media) > self._media_cache_size:
+            # The player holds its own reference to whatever it's playing, so this is safe even if it's current
+            (_, evicted) = self.__media.popitem(last=False)
+            evicted.release()
 
-        with self.__track.acquire() as track:
-            if track.value:
-                track.value.play()
-                # MediaPlayer.is_playing() will return False _immediately_ after .play(), so we need
-                # to wait a split second so we don't end up changing songs after returning from here.
-                attempts = 0
-                while attempts < 5 and not track.value.is_playing():
-                    attempts += 1
-                    time.sleep(0.1)
+        return media
 
-            self._update_track_volume_locked(track.value)
+    def _on_end_reached(self, event: Event) -> None:
+        # On one of VLC's threads, which mustn't call back into libvlc - hence just passing it on
+        self._notify_finished()
+
+    def play(self) -> None:
+        with self.__player.acquire() as player:
+            player.value.play()
+            # MediaPlayer.is_playing() will return False _immediately_ after .play(), so we need
+            # to wait a split second so we don't end up changing songs after returning from here.
+            attempts = 0
+            while attempts < 5 and not player.value.is_playing():
+                attempts += 1
+                time.sleep(0.1)
+
+            self._update_volume_locked(player.value)
 
     def pause(self) -> None:
-        with self.__track.acquire() as track:
-            if track.value:
-                self.__pause_state = (
-                    self.get_pos_locked(track.value),
-                    self.__current_playing_filename
-                )
-                
-                track.value.release()
-                track.replace_value(None)
+        with self.__player.acquire() as player:
+            player.value.set_pause(1)
 
     def unpause(self) -> None:
-        if self.__pause_state:
-            # We'll set __pause_state back to None during self.play()
-            [start_time, filename] = self.__pause_state
-            self.load(filename)
-            self.play()
-            self.set_pos(start_time)
-        else:
-            logging.warn("Attempting to unpause but there's no pause state to resume from")
-            self.play()
+        with self.__player.acquire() as player:
+            player.value.set_pause(0)
+            self._update_volume_locked(player.value)
 
     def get_busy(self) -> bool:
-        with self.__track.acquire() as track:
-            return bool(track.value) and track.value.is_playing() == 1
+        with self.__player.acquire() as player:
+            return player.value.is_playing() == 1
 
     def get_pos(self) -> int:
-        if self.__pause_state:
-            # Short circuit here to avoid grabbing lock if possible, but should still check this in lock too
-            return self.__pause_state[0]
-
-        with self.__track.acquire() as track:
-            return self.get_pos_locked(track.value)
-
-    def get_pos_locked(self, track: Optional[MediaPlayer]) -> int:
-        if self.__pause_state:
-            return self.__pause_state[0]
-        elif track:
-            return track.get_time()
-        else:
-            return 0
+        with self.__player.acquire() as player:
+            return player.value.get_time()
 
     def set_pos(self, ms: int) -> None:
-        with self.__track.acquire() as track:
-            if track.value:
-                track.value.set_time(ms)
+        with self.__player.acquire() as player:
+            player.value.set_time(ms)
 
     def get_volume(self) -> float:
-        return self.__volume   
+        return self.__volume
 
     def set_volume(self, volume: float) -> None:
         self.__volume = volume
-        self._update_track_volume()
-
-    def _update_track_volume(self) -> None:
-        with self.__track.acquire() as track:
-            self._update_track_volume_locked(track.value)
+        with self.__player.acquire() as player:
+            self._update_volume_locked(player.value)
 
-    def _update_track_volume_locked(self, track: Optional[MediaPlayer]) -> None:
-        if track and track.is_playing():
-            track.audio_set_volume(int(self.__volume * 100))
+    def _update_volume_locked(self, player: MediaPlayer) -> None:
+        # Fails (harmlessly) until the player has an audio output, which is why play() sets it again
+        player.audio_set_volume(int(self.__volume * 100))
 
-                
     def volume_min_max_step(self) -> Tuple[float, float, float]:
         return (0.0, 2.0, 0.1)
 
 speaker = VlcSpeaker()
 
-# pyright: reportMissingTypeStubs=false, reportUnknownVariableType=false, reportUnknownMemberType=false, reportUnknownArgumentType=false
\ No newline at end of file
+# pyright: reportMissingTypeStubs=false, reportUnknownVariableType=false, reportUnknownMemberType=false, reportUnknownArgumentType=false
@@ -0,0 +1,11 @@
+# Shared by benchmark.py and soak.py for building fake libraries to run against
+
+WORDS = [
+    "love", "night", "dance", "heart", "fire", "dream", "summer", "rain", "blue", "gold",
+    "remix", "live", "acoustic", "feat", "official", "video", "lyrics", "radio", "edit", "version",
+    "city", "road", "home", "light", "wild", "young", "forever", "tonight", "sky", "ocean",
+]
+
+# A single silent MPEG-1 Layer III frame (128kbps, 44.1kHz) - enough for mutagen to work out a length
+SILENT_MP3_FRAME = b"\xff\xfb\x90\x00" + bytes(413)
+FRAMES_PER_SECOND = 38
@@ -0,0 +1,71 @@
+import logging
+import os
+from concurrent.futures import Future, ThreadPoolExecutor
+from subprocess import CalledProcessError, check_output, STDOUT
+from typing import Optional
+
+from settings import THUMBNAIL_SIZES, THUMBNAIL_WORKERS
+from utils import FFMPEG, low_priority_preexec_fn
+
+# youtube-dl writes thumbnails out at full resolution, but they're only ever shown as small tiles. Each
+# one gets a set of pre-shrunk WebP variants (<id>.<width>.webp, next to the mp3) so the SD card and
+# the network only ever deal with a few KB per image.
+
+WEBP_QUALITY = 75
+
+__executor = ThreadPoolExecutor(max_workers=THUMBNAIL_WORKERS, thread_name_prefix="Thumbnails")
+
+def thumbnail_variant_path(mp3_path: str, width: int) -> str:
+	return f"{os.path.splitext(mp3_path)[0]}.{width}.webp"
+
+def source_thumbnail_path(mp3_path: str) -> Optional[str]:
+	base = os.path.splitext(mp3_path)[0]
+	for ext in [".webp", ".jpg"]:
+		if os.path.isfile(base + ext):
+			return base + ext
+
+	return None
+
+def queue_thumbnail_variants(mp3_path: str) -> "Future[int]":
+	return __executor.submit(generate_thumbnail_variants, mp3_path)
+
+def generate_thumbnail_variants(mp3_path: str) -> int:
+	source = source_thumbnail_path(mp3_path)
+	if source is None:
+		logging.debug(f"No thumbnail to generate variants from for {mp3_path}")
+		return 0
+
+	source_mtime = os.path.getmtime(source)
+	generated = 0
+
+	for width in THUMBNAIL_SIZES:
+		out_path = thumbnail_variant_path(mp3_path, width)
+		if os.path.isfile(out_path) and os.path.getmtime(out_path) >= source_mtime:
+			continue
+
+		# Written alongside then renamed over, so the webserver never serves a half written image
+		tmp_path = out_path + ".tmp"
+		try:
+			check_output([
+				FFMPEG,
+				"-y",
+				"-loglevel", "error",
+				"-i", source,
+				"-vf", f"scale='min({width},iw)':-2",
+				"-c:v", "libwebp",
+				"-quality", str(WEBP_QUALITY),
+				"-f", "webp",
+				tmp_path
+			], stderr=STDOUT, preexec_fn=low_priority_preexec_fn())
+			os.replace(tmp_path, out_path)
+			generated += 1
+		except (CalledProcessError, OSError) as ex:
+			output = ex.output.decode("utf-8", "replace").strip() if isinstance(ex, CalledProcessError) and ex.output else ex
+			logging.error(f"Could not generate {width}px thumbnail for {mp3_path}: {output}")
+			if os.path.exists(tmp_path):
+				os.remove(tmp_path)
+
+	if generated:
+		logging.info(f"Generated {generated} thumbnail variant(s) for {mp3_path}")
+
+	return generated
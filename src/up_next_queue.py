@@ -0,0 +1,150 @@
+from collections import deque
+import heapq
+from typing import Iterator, Optional, Set
+
+from song import DownloadState, Song
+
+class UpNextEntry:
+	# A handle to one queued song - what remove() takes, so nothing ever has to be searched for
+	def __init__(self, queue: "UpNextQueue", song: Song, seq: int):
+		self.queue = queue
+		self.song = song
+		self.seq = seq
+		self.prev: Optional[UpNextEntry] = None
+		self.next: Optional[UpNextEntry] = None
+		self.removed = False
+
+	def _download_state_changed(self) -> None:
+		# deque.append is atomic, so this is safe to call from a download thread
+		self.queue._pending_transitions.append(self)
+
+
+class UpNextQueue:
+	# Songs in play order as a doubly linked list, plus an index of which of them are ready to play.
+	# Queueing (front or back) and removing by handle are O(1). The ready songs are kept in a heap
+	# ordered by queue position, so finding/popping the first one to play is O(log n) rather than a
+	# scan past everything still downloading.
+	#
+	# Download state changes come in on the download threads, so they're only noted down there and
+	# get applied the next time the queue is used (under the song queue's lock).
+	def __init__(self):
+		self._head: Optional[UpNextEntry] = None
+		self._tail: Optional[UpNextEntry] = None
+		self._length = 0
+
+		# Queued at the front counts down, at the back counts up - so sequence order is play order
+		self._front_seq = 0
+		self._back_seq = 0
+
+		self._ready: "list[tuple[int, UpNextEntry]]" = []
+		self._errored: Set[UpNextEntry] = set()
+		self._pending_transitions: "deque[UpNextEntry]" = deque()
+
+	def append(self, song: Song) -> UpNextEntry:
+		entry = UpNextEntry(self, song, self._back_seq)
+		self._back_seq += 1
+
+		entry.prev = self._tail
+		if self._tail:
+			self._tail.next = entry
+		else:
+			self._head = entry
+		self._tail = entry
+
+		self._added(entry)
+		return entry
+
+	def appendleft(self, song: Song) -> UpNextEntry:
+		self._front_seq -= 1
+		entry = UpNextEntry(self, song, self._front_seq)
+
+		entry.next = self._head
+		if self._head:
+			self._head.prev = entry
+		else:
+			self._tail = entry
+		self._head = entry
+
+		self._added(entry)
+		return entry
+
+	def remove(self, entry: UpNextEntry) -> None:
+		if entry.removed:
+			return
+
+		if entry.prev:
+			entry.prev.next = entry.next
+		else:
+			self._head = entry.next
+
+		if entry.next:
+			entry.next.prev = entry.prev
+		else:
+			self._tail = entry.prev
+
+		entry.prev = entry.next = None
+		entry.removed = True
+		self._length -= 1
+
+		# Left in the ready heap, it gets skipped over when it reaches the top
+		self._errored.discard(entry)
+		entry.song.remove_download_state_listener(entry._download_state_changed)
+
+	def peek_first_ready(self) -> Optional[Song]:
+		entry = self._first_ready_entry()
+		return entry.song if entry else None
+
+	def pop_first_ready(self) -> Optional[Song]:
+		entry = self._first_ready_entry()
+		if entry is None:
+			return None
+
+		heapq.heappop(self._ready)
+		self.remove(entry)
+		return entry.song
+
+	def remove_errored(self) -> "list[Song]":
+		self._apply_transitions()
+
+		errored = list(self._errored)
+		for entry in errored:
+			self.remove(entry)
+
+		return [entry.song for entry in errored]
+
+	def __len__(self) -> int:
+		return self._length
+
+	def __iter__(self) -> Iterator[Song]:
+		entry = self._head
+		while entry:
+			yield entry.song
+			entry = entry.next
+
+	def _added(self, entry: UpNextEntry) -> None:
+		self._length += 1
+		entry.song.add_download_state_listener(entry._download_state_changed)
+		self._index(entry)
+
+	def _index(self, entry: UpNextEntry) -> None:
+		if entry.song.downloading == DownloadState.Downloaded:
+			heapq.heappush(self._ready, (entry.seq, entry))
+		elif entry.song.downloading == DownloadState.Error:
+			self._errored.add(entry)
+
+	def _apply_transitions(self) -> None:
+		while self._pending_transitions:
+			entry = self._pending_transitions.popleft()
+			if not entry.removed:
+				self._index(entry)
+
+	def _first_ready_entry(self) -> Optional[UpNextEntry]:
+		self._apply_transitions()
+
+		while self._ready:
+			(_, entry) = self._ready[0]
+			if not entry.removed:
+				return entry
+			heapq.heappop(self._ready)
+
+		return None
@@ -1,5 +1,10 @@
 import logging
-from typing import Optional, Tuple
+import os
+from typing import Any, Callable, Optional, Tuple, Union
+
+from settings import FFMPEG_LOCATION
+
+FFMPEG = os.path.join(FFMPEG_LOCATION, "ffmpeg")
 
 def secs_to_hours_mins_secs(total_secs: float) -> Tuple[int, int, int]:
     secs = int(total_secs % 60)
@@ -30,4 +35,11 @@ def get_yt_api_key() -> Optional[str]:
         except Exception as ex:
             logging.info(f"Could not load youtube API key {ex}")
     
-    return __yt_api_key
\ No newline at end of file
+    return __yt_api_key
+
+def low_priority_preexec_fn() -> Union[None, Callable[[], Any]]:
+    # For subprocesses that shouldn't compete with playback for the CPU
+    if hasattr(os, "nice"):
+        return lambda: os.nice(10)
+    else:
+        return None
\ No newline at end of file
@@ -1,6 +1,5 @@
 %from song import DownloadState
 %from playing_song import PlayingState
-%from playlist import FilePlaylist
 
 <!DOCTYPE html>
 <html lang="en">
@@ -34,11 +33,11 @@
 
         <div id="playing">
             <h2>Currently Playing</h2>
-            <img src="data:image/jpg;base64, {{song_queue.currently_playing.song.thumbnail_base64()}}" alt="{{song_queue.currently_playing.song.name}}" />
-            <div>{{song_queue.currently_playing.song.name}}</div>
-            <div>{{song_queue.currently_playing.current_elapsed_time_human_readable()}} / {{song_queue.currently_playing.song.length_human_readable()}}</div>
+            <img src="{{state.current_song.thumbnail_url(480)}}" alt="{{state.current_song.name}}" />
+            <div>{{state.current_song.name}}</div>
+            <div>{{state.current_elapsed_time_human_readable()}} / {{state.current_song.length_human_readable()}}</div>
             <div id="playing_controls" class="controls">
-                %if song_queue.currently_playing.playing_state == PlayingState.Playing:
+                %if state.playing_state == PlayingState.Playing:
                     <form method="POST" action="/pause">
                         <button type="submit">⏸</button>
                     </form>
@@ -53,17 +52,17 @@
                 </form>
 
                 <span>
-                    %if current_volume == 0:
+                    %if state.volume == 0:
                         🔈
-                    %elif current_volume < 0.4:
+                    %elif state.volume < 0.4:
                         🔉
                     %else:
                         🔊
                     %end
                 </span>
                 <form id="volume_form" method="POST" action="/volume">
-                    %(vol_min, vol_max, vol_step) = vol_min_max_step
-                    <input type="range" name="volume" min="{{vol_min}}" max="{{vol_max}}" step="{{vol_step}}" value="{{current_volume}}">
+                    %(vol_min, vol_max, vol_step) = state.vol_min_max_step
+                    <input type="range" name="volume" min="{{vol_min}}" max="{{vol_max}}" step="{{vol_step}}" value="{{state.volume}}">
                     <button type="submit">✔</button>
                 </form>
             </div>
@@ -71,7 +70,7 @@
             %if username is not None:
                 <div id="user_rating">
                     <form method="POST" action="/rateSong">
-                        <input type="hidden" name="song_id" value="{{song_queue.currently_playing.song.id}}" />
+                        <input type="hidden" name="song_id" value="{{state.current_song.id}}" />
                         <button type="submit" name="rating" value="1">{{"⭐" if rating and rating >= 1 else "☆"}}</button>
                         <button type="submit" name="rating" value="2">{{"⭐" if rating and rating >= 2 else "☆"}}</button>
                         <button type="submit" name="rating" value="3">{{"⭐" if rating and rating >= 3 else "☆"}}</button>
@@ -84,14 +83,20 @@
 
         <div id="upcoming">
             <h2>Upcoming</h2>
-            %if len(song_queue.up_next) > 0:
+            %if len(state.up_next) > 0:
                 <ol>
-                    %for s in song_queue.up_next:
+                    %for s in state.up_next:
                         <li>
-                            <img src="data:image/jpg;base64, {{s.thumbnail_base64()}}" alt="{{s.name}}" />
+                            <img src="{{s.thumbnail_url(160)}}" alt="{{s.name}}" />
                             <span>{{s.name}}</span>
                             %if s.downloading == DownloadState.Downloading:
                             <span>Downloading ({{s.download_percentage}}%)...</span>
+                            %if s.downloading_video_id:
+                            <form method="POST" action="/downloads/cancel">
+                                <input type="hidden" name="video_id" value="{{s.downloading_video_id}}" />
+                                <input type="submit" value="Cancel" />
+                            </form>
+                            %end
                             %elif s.downloading == DownloadState.Error:
                             <span>Error downloading (See logs)</span>
                             %end
@@ -109,18 +114,22 @@
             <form method="POST" action="/playlist">
                 <label for="playlist_selector">Change playlist:</label>
                 <select id="playlist_selector" name="playlist_id">
-                    %for playlist in FilePlaylist.all_available_playlists():
-                        %selected = "selected" if playlist.id == song_queue.playlist.id else ""
-                        <option value="{{playlist.id}}" {{selected}}>{{playlist.name}}</option>
+                    %for (playlist_id, playlist_name) in state.playlists:
+                        %selected = "selected" if playlist_id == state.playlist_id else ""
+                        <option value="{{playlist_id}}" {{selected}}>{{playlist_name}}</option>
                     %end
                 </select>
                 
                 <label for="playlist_shuffle">Shuffle</label>
-                <input id="playlist_shuffle" name="shuffle" type="checkbox" {{"checked" if song_queue.playlist.shuffle else ""}} />
+                <input id="playlist_shuffle" name="shuffle" type="checkbox" {{"checked" if state.playlist_shuffle else ""}} />
 
                 <button type="submit">Change Playlist</button>
             </form>
 
+            %if state.playlist_id != -1:
+            <a href="/playlist/{{state.playlist_id}}/export">Export current playlist</a>
+            %end
+
             <form method="POST" action="createPlaylist">
                 <label for="playlist_create_input">Create Playlist</label>
                 <input id="playlist_create_input" name="url" placeholder="URL" />
@@ -26,7 +26,7 @@ page_link_url = lambda search, page: f"?search={search}&page={page}" if search e
                 % # Can be either a Song or a SearchResult, so act accordingly:
                 % if hasattr(s, "downloading"):
                     <li class="flex_and_centre">
-                        <img src="data:image/jpg;base64, {{s.thumbnail_base64()}}" alt="{{s.name}}" />
+                        <img src="{{s.thumbnail_url(160)}}" alt="{{s.name}}" />
                         <span class="flex_fill">{{s.name}}</span>
                         <span>
                             <form method="POST" action="/songs/play">
@@ -1,46 +1,131 @@
+import heapq
+import logging
+import threading
 import time
 from typing import Optional
 from datetime import datetime, timedelta, timezone
 
-from database import database
+from database import database, User
 
 class Sessions:
-    __session_last_active: "dict[str, float]" = {}
+    # Every request checks its session, so they're all kept in memory (written through to the DB on
+    # create/expire) rather than looked up each time. A background sweeper drops the expired ones.
+    _sweep_interval_secs = 10 * 60
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._sessions: "dict[str, Session]" = {}
+        self._expiry_queue: "list[tuple[float, str]]" = []
+        self._users: "dict[int, User]" = {}
+
+        for db_session in database.get_active_sessions():
+            session = Session(db_session.user_id, db_session.id, _parse_expiry(db_session.expires_at))
+            # Nobody has been active since the restart yet
+            session.last_active = 0
+            self._add_locked(session)
+
+        logging.info(f"Loaded {len(self._sessions)} active session(s)")
+
+        threading.Thread(target=self._sweep_forever, name="SessionSweeper", daemon=True).start()
 
     def create_session_for_user(self, user_id: int) -> str:
         self.expire_users_session(user_id)
 
-        expires_at = (datetime.now(timezone.utc) + timedelta(days=90)).replace(microsecond=0).isoformat()
-        return database.create_session(user_id, expires_at)
+        expires_at = (datetime.now(timezone.utc) + timedelta(days=90)).replace(microsecond=0)
+        session_id = database.create_session(user_id, expires_at.isoformat())
+
+        with self._lock:
+            self._add_locked(Session(user_id, session_id, expires_at.timestamp()))
+
+        return session_id
 
     def expire_session(self, session_id: str) -> None:
+        with self._lock:
+            self._sessions.pop(session_id, None)
+
         database.remove_session(session_id)
 
     def expire_users_session(self, user_id: int) -> None:
+        with self._lock:
+            for session in [s for s in self._sessions.values() if s.user_id == user_id]:
+                del self._sessions[session.session_id]
+
         database.remove_users_session(user_id)
 
     def user_id_from_session(self, session_id: str) -> Optional[int]:
-        session = database.get_session(session_id)
+        session = self._active_session(session_id)
         return session.user_id if session else None
-    
+
+    def user_from_session(self, session_id: str) -> Optional[User]:
+        user_id = self.user_id_from_session(session_id)
+        if user_id is None:
+            return None
+
+        # Users never change once created, so it's safe to hang on to them
+        user = self._users.get(user_id)
+        if user is None:
+            user = database.get_user(user_id)
+            if user is not None:
+                self._users[user_id] = user
+
+        return user
+
     def update_last_active(self, session_id: str) -> None:
-        session = database.get_session(session_id)
+        session = self._active_session(session_id)
         if session:
-            self.__session_last_active[session.id] = time.time()
-    
+            session.last_active = time.time()
+
     def recently_active_users(self) -> "list[int]":
-        active_sessions = database.get_active_sessions()
-        result = []
         now = time.time()
         one_hour_in_seconds = 60 * 60
 
-        for session in active_sessions:
-            if now - self.__session_last_active.get(session.id, 0) < one_hour_in_seconds:
-                result.append(session.user_id)
-        return result
-    
+        with self._lock:
+            return [
+                s.user_id for s in self._sessions.values()
+                if s.expires_at > now and now - s.last_active < one_hour_in_seconds
+            ]
+
+    def purge_expired_sessions(self) -> None:
+        now = time.time()
+        purged = 0
+
+        with self._lock:
+            while self._expiry_queue and self._expiry_queue[0][0] <= now:
+                (_, session_id) = heapq.heappop(self._expiry_queue)
+                session = self._sessions.get(session_id)
+                if session is not None and session.expires_at <= now:
+                    del self._sessions[session_id]
+                    purged += 1
+
+        if purged:
+            logging.info(f"Purged {purged} expired session(s)")
+            database.remove_expired_sessions()
+
+    def _active_session(self, session_id: str) -> "Optional[Session]":
+        session = self._sessions.get(session_id)
+        if session is None or session.expires_at <= time.time():
+            return None
+
+        return session
+
+    def _add_locked(self, session: "Session") -> None:
+        self._sessions[session.session_id] = session
+        heapq.heappush(self._expiry_queue, (session.expires_at, session.session_id))
+
+    def _sweep_forever(self) -> None:
+        while True:
+            time.sleep(self._sweep_interval_secs)
+            try:
+                self.purge_expired_sessions()
+            except:
+                logging.exception("Error while purging expired sessions")
+
 class Session:
-    def __init__(self, user_id: int, session_id: str) -> None:
+    def __init__(self, user_id: int, session_id: str, expires_at: float) -> None:
         self.user_id = user_id
         self.session_id = session_id
+        self.expires_at = expires_at
         self.last_active = time.time()
+
+def _parse_expiry(expires_at: str) -> float:
+    return datetime.fromisoformat(expires_at).timestamp()
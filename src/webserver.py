@@ -1,21 +1,26 @@
 import logging
 import math
+import os
 import queue
 from typing import NoReturn, Optional, Union
 
 from database import database
+from download_manager import download_manager
+from music_player import command_batch_stats
 from mutex import Mutex
 from song import DownloadState, Song
 from song_queue import SongQueue
 from commands import Command, PlayCommand, PauseCommand, QueueCommand, SkipCommand, VolumeCommand, ChangePlaylistCommand, CreatePlaylistFromUrlCommand, DeleteCommand
 from speaker import speaker
 
-from bottle import get, hook, post, run, template, static_file, request, response, redirect
-from settings import WEBSERVER_IP, WEBSERVER_PORT, SONGS_PER_PAGE
+from bottle import HTTPResponse, get, hook, post, run, template, static_file, request, response, redirect
+from settings import WEBSERVER_IP, WEBSERVER_PORT, SONGS_PER_PAGE, THUMBNAIL_SIZES
 from users import authenticate_user
 from web_sessions import Sessions
 from youtube_api import SearchResult, search_youtube
 
+THUMBNAIL_MAX_AGE_SECS = 7 * 24 * 60 * 60
+
 def start_webserver(event_queue: "queue.Queue[Command]", song_queue: Mutex[SongQueue]):
 	try:
 		logging.info("Background server thread starting up! Setting up routes")
@@ -30,6 +35,8 @@ def setup_routes(event_queue: "queue.Queue[Command]", song_queue: Mutex[SongQueu
 	sessions = Sessions()
 	with song_queue.acquire() as sq:
 		sq.value.default_all_playlist.whos_listening = lambda: sessions.recently_active_users()
+		# Only ever used to read .snapshot, which is published for exactly this - no lock needed
+		queue_state = sq.value
 
 	def _get_session_id():
 		return request.get_cookie("authSession", "")
@@ -37,9 +44,7 @@ def setup_routes(event_queue: "queue.Queue[Command]", song_queue: Mutex[SongQueu
 	def _get_user():
 		session_id = _get_session_id()
 		if session_id is None: return None
-		user_id = sessions.user_id_from_session(session_id)
-		if user_id is None: return None
-		return database.get_user(user_id)
+		return sessions.user_from_session(session_id)
 	
 	def _get_str_param(name: str) -> Optional[str]:
 		param = request.query.get(name) or request.forms.get(name) # type: ignore Bad typings on the .get(...)
@@ -83,24 +88,61 @@ def setup_routes(event_queue: "queue.Queue[Command]", song_queue: Mutex[SongQueu
 		user = _get_user()
 		logging.info(user.name if user else "<>")
 
-		with song_queue.acquire() as sq:
-			current_volume = speaker().get_volume()
-			vol_min_max_step = speaker().volume_min_max_step()
+		state = queue_state.snapshot
+		rating = database.get_rating_for_song(user.id, state.current_song.id) if user else 0
 
-			rating = database.get_rating_for_song(user.id, sq.value.currently_playing.song.id) if user else 0
-			
-			return template("index",
-				song_queue=sq.value,
-				current_volume=current_volume,
-				vol_min_max_step=vol_min_max_step,
-				username=user.name if user else None,
-				rating=rating
-			)
+		return template("index",
+			state=state,
+			username=user.name if user else None,
+			rating=rating
+		)
 
 	@get("/static/<filename:path>")
 	def static(filename: str):
 		return static_file(filename, root="./static/")
 
+	@get("/thumbnail/<song_id:int>")
+	def thumbnail(song_id: int):
+		try:
+			width = _get_int_param("width")
+		except:
+			width = None
+
+		db_song = database.get_song(song_id) if song_id != -1 else None
+		song = Song.from_db_song(db_song, DownloadState.Downloaded) if db_song else None
+		path = None
+		if song is not None:
+			path = song.thumbnail_path_for(width) if width else song.thumbnail_path
+
+		if path is None or not os.path.isfile(path):
+			# Might just not be downloaded yet, so don't let the browser hang on to this for long
+			return _cacheable_file(os.path.abspath("./static/questionMark.png"), 60)
+
+		if song is not None and width and width <= max(THUMBNAIL_SIZES) and path == song.thumbnail_path:
+			# The full size original standing in until the variant is generated - if it were cached for long, the
+			# browser would keep using it under the small variant's URL
+			return _cacheable_file(path, 60)
+
+		return _cacheable_file(path, THUMBNAIL_MAX_AGE_SECS)
+
+	def _cacheable_file(path: str, max_age_secs: int):
+		stat = os.stat(path)
+		etag = f'"{stat.st_ino:x}-{stat.st_size:x}-{stat.st_mtime_ns:x}"'
+		headers = {
+			"ETag": etag,
+			"Cache-Control": f"public, max-age={max_age_secs}",
+		}
+
+		if etag in [t.strip() for t in request.environ.get("HTTP_IF_NONE_MATCH", "").split(",")]:
+			return HTTPResponse(status=304, **headers)
+
+		# static_file handles Last-Modified/If-Modified-Since and hands the open file to the server's
+		# wsgi.file_wrapper, so servers that support it can sendfile() rather than copy it through Python
+		result = static_file(os.path.basename(path), root=os.path.dirname(path))
+		for (name, value) in headers.items():
+			result.set_header(name, value)
+		return result
+
 	@post("/play")
 	def play():
 		event_queue.put_nowait(PlayCommand())
@@ -149,6 +191,24 @@ def setup_routes(event_queue: "queue.Queue[Command]", song_queue: Mutex[SongQueu
 		event_queue.put_nowait(SkipCommand())
 		return redirect("/")
 
+	@post("/downloads/cancel")
+	def cancel_download():
+		video_id = ""
+
+		try:
+			video_id = _get_str_param("video_id") or _throw_bad_param("video_id")
+		except:
+			logging.exception("Bad input for cancel download endpoint")
+			response.status = 400
+			error_message = f"Cancel download parameters not specified or invalid: video_id='{video_id}'"
+			return template("error", error_message=error_message)
+
+		# The song goes to Error and drops out of the queue like any other failed download
+		if not download_manager.cancel(video_id):
+			logging.info(f"Not cancelling {video_id}, it isn't being downloaded")
+
+		return redirect("/")
+
 	@post("/playlist")
 	def playlist():
 		playlist_id = ""
@@ -167,6 +227,18 @@ def setup_routes(event_queue: "queue.Queue[Command]", song_queue: Mutex[SongQueu
 
 		return redirect("/")
 
+	@get("/playlist/<playlist_id:int>/export")
+	def export_playlist(playlist_id: int):
+		playlist = database.get_playlist(playlist_id)
+		if playlist is None:
+			response.status = 404
+			return template("error", error_message=f"No playlist with id {playlist_id}")
+
+		# Streamed out as it's read, so even a huge playlist never has to be held in memory at once
+		response.content_type = "text/plain; charset=utf-8"
+		response.set_header("Content-Disposition", f'attachment; filename="playlist-{playlist_id}.txt"')
+		return (f"https://www.youtube.com/watch?v={s.youtube_id}\t{s.name}\n" for s in database.iter_playlist_songs(playlist_id))
+
 	@post("/createPlaylist")
 	def createPlaylist():
 		url = ""
@@ -220,43 +292,53 @@ def setup_routes(event_queue: "queue.Queue[Command]", song_queue: Mutex[SongQueu
 		logging.info(f"force_search_youtube = {force_search_youtube}")
 
 		if search_terms:
-			db_songs = database.search_songs(search_terms)
+			song_count = database.get_search_song_count(search_terms)
 		else:
-			db_songs = database.get_songs()
+			song_count = database.get_total_song_count()
 
-		songs: list[Union[Song, SearchResult]] = [Song.from_db_song(s, DownloadState.Downloaded) for s in db_songs]
-		song_count = len(songs)
+		total_pages = math.ceil(song_count / SONGS_PER_PAGE)
+		if page > total_pages:
+			page = total_pages
+			logging.info(f"Page is above max ({total_pages}), clamping to max")
 
-		start = (page - 1) * SONGS_PER_PAGE
+		start = (max(page, 1) - 1) * SONGS_PER_PAGE
 		end = start + SONGS_PER_PAGE
+
+		songs: list[Union[Song, SearchResult]] = []
+		if start < song_count:
+			if search_terms:
+				db_songs = database.search_songs(search_terms, start, SONGS_PER_PAGE)
+			else:
+				db_songs = database.get_songs(start, SONGS_PER_PAGE)
+
+			songs += [Song.from_db_song(s, DownloadState.Downloaded) for s in db_songs]
 		
 		youtube_searched = False
 
 		# If we didn't find any songs (or it's been requested), also perform a search via the YouTube API
-		if search_terms and (len(songs) == 0 or force_search_youtube):
+		if search_terms and (song_count == 0 or force_search_youtube):
 			results = search_youtube(search_terms, "video") or []
 			youtube_searched = True
 
+			# Only needed to de-dupe, and only when there are local results to double up with
+			local_song_ids = database.get_search_matching_song_ids(search_terms, [r.video_id for r in results]) if song_count > 0 else set()
+			youtube_songs: list[Union[Song, SearchResult]] = []
+
 			for result in results:
 				existing_song_db = database.get_song_by_youtube_id(result.video_id)
 
 				# Make sure to not double up on any results that may already be retrieved earlier
 				if existing_song_db is not None:
-					existing_song = next((x for x in songs if isinstance(x, Song) and x.id == existing_song_db.id), None)
-					if existing_song is None:
-						songs.append(Song.from_db_song(existing_song_db, DownloadState.Downloaded))
+					if existing_song_db.id not in local_song_ids:
+						youtube_songs.append(Song.from_db_song(existing_song_db, DownloadState.Downloaded))
 				else:
-					songs.append(result)
+					youtube_songs.append(result)
 
 			# Sort the songs so already-downloaded songs appear first
-			songs.sort(key=lambda s: not isinstance(s, Song))
+			youtube_songs.sort(key=lambda s: not isinstance(s, Song))
 
-		total_pages = math.ceil(song_count / SONGS_PER_PAGE)
-		if page > total_pages:
-			page = total_pages
-			logging.info(f"Page is above max ({total_pages}), clamping to max")
-		
-		songs = songs[start:end]
+			# YouTube results come after every local result, so only show whichever of them land on this page
+			songs += youtube_songs[max(start - song_count, 0):max(end - song_count, 0)]
 
 		return template("songs", songs=songs, search=search_terms, youtube_searched=youtube_searched, current_page=page, total_pages=total_pages)
 
@@ -334,6 +416,23 @@ def setup_routes(event_queue: "queue.Queue[Command]", song_queue: Mutex[SongQueu
 		return redirect("/")
 	
 
+	@get("/debug/queries")
+	def debug_queries():
+		# Has the raw SQL and query plans in it, so not for just anyone on the network
+		if _get_user() is None:
+			logging.info("Unauthenticated user in debug/queries, exiting")
+			response.status = 403
+			return redirect("/login")
+
+		return {
+			"queries": database.query_stats(),
+			"song_cache": database.song_cache_stats(),
+			"song_queue_lock": song_queue.stats(),
+			"command_batches": command_batch_stats.summary(),
+			"speaker": speaker().stats(),
+			"downloads": download_manager.stats(),
+		}
+
 	@post("/rateSong")
 	def rate_song():
 		user = _get_user()
@@ -354,9 +453,8 @@ def setup_routes(event_queue: "queue.Queue[Command]", song_queue: Mutex[SongQueu
 			error_message = f"Login parameters not specified or invalid"
 			return template("error", error_message=error_message)
 		
-		with song_queue.acquire() as sq:
-			if sq.value.currently_playing.song.id != song_id:
-				logging.warning("song name not current song, skipping user rating")
+		if queue_state.snapshot.current_song.id != song_id:
+			logging.warning("song name not current song, skipping user rating")
 
 		database.add_rating(user.id, song_id, rating)
 
@@ -1,15 +1,19 @@
 import logging
 from subprocess import CalledProcessError, Popen, check_output, PIPE, STDOUT
 import os
-from typing import Any, Callable, Optional, Union
+import threading
+from typing import Callable, Optional
 
 from settings import MUSIC_DIR, YOUTUBE_DL_COMMAND, FFMPEG_LOCATION
+from utils import low_priority_preexec_fn
 
 YOUTUBE_DL = YOUTUBE_DL_COMMAND
 
 OUT_PATH = os.path.join(MUSIC_DIR, "%(id)s.%(ext)s")
 
-def download_audio(url: str, progress_callback: Optional[Callable[[float], None]]=None) -> None:
+class DownloadCancelled(Exception): pass
+
+def download_audio(url: str, progress_callback: Optional[Callable[[float], None]]=None, cancel_event: Optional[threading.Event]=None) -> None:
 	logging.info(f"Starting download of '{url}'")
 
 	p = Popen([
@@ -22,12 +26,19 @@ def download_audio(url: str, progress_callback: Optional[Callable[[float], None]
 		"--write-thumbnail",
 		"--ffmpeg-location", FFMPEG_LOCATION,
 		"-o", OUT_PATH
-	], universal_newlines=True, stdout=PIPE, stderr=STDOUT, preexec_fn=_preexec_fn())
+	], universal_newlines=True, stdout=PIPE, stderr=STDOUT, preexec_fn=low_priority_preexec_fn())
 
 	if p.stdout is None:
 		raise Exception()
 
 	for line in iter(p.stdout.readline, ""):
+		# youtube-dl prints a progress line every fraction of a second, so this notices fairly quickly
+		if cancel_event is not None and cancel_event.is_set():
+			p.kill()
+			p.wait()
+			logging.info(f"Download of '{url}' cancelled")
+			raise DownloadCancelled(url)
+
 		if progress_callback is not None and "[download]" in line and "%" in line:
 			download_percent = _parse_download_progress(line)
 			progress_callback(download_percent)
@@ -59,7 +70,7 @@ def get_title(url: str) -> str:
 		"--no-playlist",
 		"--skip-download",
 		"--get-title"
-	], preexec_fn=_preexec_fn())
+	], preexec_fn=low_priority_preexec_fn())
 
 	title = out.decode("utf-8").strip()
 	
@@ -75,7 +86,7 @@ def get_id(url: str) -> str:
 		"--no-playlist",
 		"--skip-download",
 		"--get-id"
-	], preexec_fn=_preexec_fn())
+	], preexec_fn=low_priority_preexec_fn())
 
 	id = out.decode("utf-8").strip()
 
@@ -92,17 +103,11 @@ def get_filename(url: str) -> str:
 		"--skip-download",
 		"--get-filename",
 		"-o", OUT_PATH
-	], preexec_fn=_preexec_fn())
+	], preexec_fn=low_priority_preexec_fn())
 	
 	p = out.decode("utf-8").strip()
 	base = os.path.splitext(p)[0]
 	filename = base + ".mp3"
 	
 	logging.info(f"Filename '{filename}' retrieved for '{url}'")
-	return filename
-
-def _preexec_fn() -> Union[None, Callable[[], Any]]:
-	if hasattr(os, "nice"):
-		return lambda: os.nice(10)
-	else:
-		return None
\ No newline at end of file
+	return filename
\ No newline at end of file
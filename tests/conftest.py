@@ -0,0 +1,17 @@
+import os
+import sys
+import tempfile
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+sys.path.insert(0, SRC_DIR)
+
+# Has to happen before anything imports the database or the speaker, which read these at import time
+import settings
+
+_workdir = tempfile.mkdtemp(prefix="mp_tests_")
+settings.DATA_DIRECTORY = _workdir
+settings.MUSIC_DIR = os.path.join(_workdir, "music")
+settings.DATABASE_FILE = os.path.join(_workdir, "database.db")
+settings.PREFERRED_AUDIO_OUTPUT_ORDER = ["simulated"]
+settings.SIMULATED_SPEAKER_SPEED = 1.0
+os.makedirs(settings.MUSIC_DIR, exist_ok=True)
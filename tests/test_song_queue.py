@@ -0,0 +1,31 @@
+from database import database
+from song import DownloadState, Song
+from song_queue import SongQueue
+
+def _queue_with_songs(count: int) -> "tuple[SongQueue, list[Song]]":
+	ids = database.add_songs([(f"Song {i}", f"vid{i:08d}", 0) for i in range(count)])
+	songs = []
+	for id in ids:
+		db_song = database.get_song(id)
+		assert db_song is not None
+		songs.append(Song.from_db_song(db_song, DownloadState.Downloaded))
+
+	sq = SongQueue()
+	for s in songs:
+		sq.queue_song(s)
+	return (sq, songs)
+
+def test_multi_skip_matches_single_skips():
+	(single, songs) = _queue_with_songs(5)
+	for _ in range(3):
+		single.next_song()
+
+	multi = SongQueue()
+	for s in songs:
+		multi.queue_song(s)
+	multi.next_song(3)
+
+	assert multi.currently_playing.song == single.currently_playing.song == songs[2]
+	assert list(multi.recently_played) == list(single.recently_played)
+	assert list(multi.up_next) == list(single.up_next) == songs[3:]
+	assert songs[0] in multi.recently_played and songs[1] in multi.recently_played